@@ -0,0 +1,214 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+import gspread
+from oauth2client.service_account import ServiceAccountCredentials
+
+logger = logging.getLogger(__name__)
+
+# Events that could not be written to the primary sink end up here
+ANALYTICS_FALLBACK_PATH = os.environ.get("MOSAIC_ANALYTICS_FALLBACK", "analytics_fallback.jsonl")
+
+GOOGLE_SHEETS_SCOPE = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
+
+# Tells the writer thread to stop
+_STOP = object()
+
+
+class GoogleSheetsSink:
+    """Appends rows to worksheets of one Google spreadsheet through a single cached client.
+
+    The client is authorized on first use and reused; after a failed write it is dropped
+    so the next write reconnects.
+
+    Args:
+        credentials_info: Service account key as a dict.
+        spreadsheet: Name of the spreadsheet to open.
+    """
+
+    def __init__(self, credentials_info, spreadsheet="lego_feedback"):
+        self.credentials_info = credentials_info
+        self.spreadsheet = spreadsheet
+        self._document = None
+        self._worksheets = {}
+
+    def _worksheet(self, index):
+        if self._document is None:
+            creds = ServiceAccountCredentials.from_json_keyfile_dict(self.credentials_info,
+                                                                     GOOGLE_SHEETS_SCOPE)
+            self._document = gspread.authorize(creds).open(self.spreadsheet)
+            self._worksheets = {}
+        if index not in self._worksheets:
+            self._worksheets[index] = self._document.get_worksheet(index)
+        return self._worksheets[index]
+
+    def append_rows(self, worksheet, rows):
+        try:
+            self._worksheet(worksheet).append_rows(rows)
+        except Exception:
+            self._document = None
+            raise
+
+
+class FileSink:
+    """Appends rows as JSON lines to a local file."""
+
+    def __init__(self, path=ANALYTICS_FALLBACK_PATH):
+        self.path = path
+
+    def append_rows(self, worksheet, rows):
+        with open(self.path, "a", encoding="utf-8") as f:
+            for row in rows:
+                f.write(json.dumps({"worksheet": worksheet, "row": row}) + "\n")
+
+
+class MemorySink:
+    """Keeps rows in memory; a stand-in for the spreadsheet in local runs and tests.
+
+    Attributes:
+        rows: List of (worksheet, row) tuples in the order they were written.
+        batches: Number of append_rows calls.
+    """
+
+    def __init__(self):
+        self.rows = []
+        self.batches = 0
+
+    def append_rows(self, worksheet, rows):
+        self.batches += 1
+        self.rows.extend((worksheet, row) for row in rows)
+
+
+class EventLogger:
+    """Buffers analytics rows and writes them in batches from a background thread.
+
+    log() only enqueues the row, so callers never wait for the network. The writer
+    thread sends a batch once ``batch_size`` rows are waiting or ``flush_interval``
+    seconds after the oldest unsent row, with one append_rows call per worksheet.
+    Failed writes are retried with exponential backoff, then handed to ``fallback``.
+
+    Args:
+        sink: Object with an ``append_rows(worksheet, rows)`` method.
+        fallback: Sink for rows the primary sink could not take (None drops them).
+        batch_size: Maximum number of rows per batch.
+        flush_interval: Longest time in seconds a row waits before its batch is sent.
+        retries: Number of retries after a failed write.
+        backoff: Delay in seconds before the first retry; doubled for every further retry.
+    """
+
+    def __init__(self, sink, fallback=None, batch_size=50, flush_interval=2.0, retries=3, backoff=0.5):
+        self.sink = sink
+        self.fallback = fallback
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retries = retries
+        self.backoff = backoff
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="analytics-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def log(self, worksheet, row):
+        """Queue one row for ``worksheet`` (its index within the spreadsheet)."""
+        self._queue.put((worksheet, list(row)))
+
+    def flush(self, timeout=None):
+        """Write every row logged so far; True if that finished within ``timeout`` seconds."""
+        if not self._thread.is_alive():
+            return False
+        written = threading.Event()
+        self._queue.put(written)
+        return written.wait(timeout)
+
+    def close(self, timeout=10):
+        """Write the remaining rows and stop the writer thread."""
+        if self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join(timeout)
+
+    def _run(self):
+        batch = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            if item is _STOP:
+                self._write(batch)
+                return
+            if isinstance(item, threading.Event):
+                self._write(batch)
+                batch, deadline = [], None
+                item.set()
+                continue
+            if item is not None:
+                batch.append(item)
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+            if item is None or len(batch) >= self.batch_size:
+                self._write(batch)
+                batch, deadline = [], None
+
+    def _write(self, batch):
+        by_worksheet = {}
+        for worksheet, row in batch:
+            by_worksheet.setdefault(worksheet, []).append(row)
+
+        for worksheet, rows in by_worksheet.items():
+            for attempt in range(self.retries + 1):
+                try:
+                    self.sink.append_rows(worksheet, rows)
+                    break
+                except Exception as e:
+                    if attempt == self.retries:
+                        logger.warning("Writing %d analytics rows failed: %s", len(rows), e)
+                        self._write_fallback(worksheet, rows)
+                    else:
+                        time.sleep(self.backoff * 2 ** attempt)
+
+    def _write_fallback(self, worksheet, rows):
+        if self.fallback is None:
+            return
+        try:
+            self.fallback.append_rows(worksheet, rows)
+        except Exception as e:
+            logger.warning("Writing %d analytics rows to the fallback failed: %s", len(rows), e)
+
+
+_EVENT_LOGGER = None
+_EVENT_LOGGER_LOCK = threading.Lock()
+
+
+def get_event_logger(sink_factory):
+    """Return the process-wide EventLogger, creating it on first use.
+
+    Args:
+        sink_factory: Called once to build the primary sink; if it raises (e.g. because no
+            credentials are configured), rows go straight to the file fallback.
+    """
+    global _EVENT_LOGGER
+    with _EVENT_LOGGER_LOCK:
+        if _EVENT_LOGGER is None:
+            fallback = FileSink()
+            try:
+                sink = sink_factory()
+            except Exception as e:
+                logger.warning("Analytics sink unavailable, logging to %s: %s", fallback.path, e)
+                sink, fallback = fallback, None
+            _EVENT_LOGGER = EventLogger(sink, fallback)
+        return _EVENT_LOGGER
+
+
+def set_event_logger(event_logger):
+    """Replace the process-wide EventLogger, e.g. with one writing to a MemorySink."""
+    global _EVENT_LOGGER
+    with _EVENT_LOGGER_LOCK:
+        _EVENT_LOGGER = event_logger
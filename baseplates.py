@@ -0,0 +1,72 @@
+# Standard baseplate sizes
+BASEPLATE_SIZES = [
+    {"name": "32×32 (standard)", "size": 32, "elementId": 6061048},
+    {"name": "48×48 (standard)", "size": 48, "elementId": 11024},
+    {"name": "64×64", "size": 64, "elementId": 6061048},
+    {"name": "96×96", "size": 96, "elementId": 11024},
+    {"name": "128×128", "size": 128, "elementId": 6061048},
+]
+
+# Square baseplates a mosaic can be tiled from, by side length in studs. No elementId is
+# recorded for the 16×16 plate, so it is listed without one.
+PLATE_ELEMENT_IDS = {48: 11024, 32: 6061048, 16: None}
+
+
+class BaseplateLayout:
+    """A grid of equal square baseplates covering a width × height mosaic.
+
+    Attributes:
+        width: Mosaic width in studs.
+        height: Mosaic height in studs.
+        plate_size: Side length of each baseplate in studs.
+        columns: Number of plates across.
+        rows: Number of plates down.
+    """
+
+    def __init__(self, width, height, plate_size):
+        self.width = width
+        self.height = height
+        self.plate_size = plate_size
+        self.columns = -(-width // plate_size)
+        self.rows = -(-height // plate_size)
+
+    @property
+    def count(self):
+        return self.columns * self.rows
+
+    @property
+    def element_id(self):
+        return PLATE_ELEMENT_IDS.get(self.plate_size)
+
+    @property
+    def name(self):
+        return f"{self.plate_size}×{self.plate_size}"
+
+    def tiles(self):
+        """Yield (row, column, (top, left, bottom, right)) for every plate, clipped to the mosaic."""
+        for row in range(self.rows):
+            for column in range(self.columns):
+                top = row * self.plate_size
+                left = column * self.plate_size
+                yield row, column, (top, left, min(top + self.plate_size, self.height),
+                                    min(left + self.plate_size, self.width))
+
+
+def mosaic_dimensions(mosaic_size):
+    """Normalize a mosaic size given as an int (square) or a (width, height) pair."""
+    if isinstance(mosaic_size, (tuple, list)):
+        width, height = mosaic_size
+        return int(width), int(height)
+    return int(mosaic_size), int(mosaic_size)
+
+
+def plan_baseplates(width, height, plate_sizes=tuple(PLATE_ELEMENT_IDS)):
+    """Choose the baseplate grid for a mosaic.
+
+    Uses the largest plate size that tiles the mosaic exactly; if none does, the smallest
+    plate size, with the last row and column of plates only partly covered.
+    """
+    for plate_size in sorted(plate_sizes, reverse=True):
+        if width % plate_size == 0 and height % plate_size == 0:
+            return BaseplateLayout(width, height, plate_size)
+    return BaseplateLayout(width, height, min(plate_sizes))
@@ -0,0 +1,235 @@
+"""Convert whole directories of images into LEGO mosaics from the command line.
+
+Example:
+    python batch.py photos/ --out mosaics/ --size 48 --workers 4
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image
+
+from dither import DITHER_MODES
+from encoding import IMAGE_FORMATS, encode_image
+from lego_colors import LEGO_COLORS_ALL
+from lego_colors_round import LEGO_COLORS_ROUND
+from lego_colors_round_available import LEGO_COLORS_ROUND_AVAILABLE
+from lego_colors_square import LEGO_COLORS_SQUARE
+from lego_colors_square_available import LEGO_COLORS_SQUARE_AVAILABLE
+from palette_index import METRICS
+from utils import create_mosaic, draw_instructions, draw_mosaic, shopping_list, shopping_list_csv
+from vector_instructions import VECTOR_FORMATS, vector_instructions
+
+PALETTES = {
+    "square-available": LEGO_COLORS_SQUARE_AVAILABLE,
+    "round-available": LEGO_COLORS_ROUND_AVAILABLE,
+    "square": LEGO_COLORS_SQUARE,
+    "round": LEGO_COLORS_ROUND,
+    "all": LEGO_COLORS_ALL,
+}
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".bmp", ".tif", ".tiff")
+
+# Timed steps of every conversion, in order
+STAGES = ("load", "generate", "preview", "instructions", "shopping_list")
+
+
+def parse_size(text):
+    """Parse a mosaic size given as "48" or "64x48"."""
+    width, _, height = text.lower().replace("×", "x").partition("x")
+    return int(width) if not height else (int(width), int(height))
+
+
+def collect_tasks(source, default_size):
+    """List (image path, mosaic size) pairs from a directory or a manifest file.
+
+    A manifest is a CSV file with a ``path`` column and an optional ``size`` column, or a
+    text file with one image path per line. Relative paths are resolved against the
+    manifest's directory.
+    """
+    if os.path.isdir(source):
+        names = sorted(n for n in os.listdir(source) if n.lower().endswith(IMAGE_EXTENSIONS))
+        return [(os.path.join(source, name), default_size) for name in names]
+
+    base = os.path.dirname(os.path.abspath(source))
+    tasks = []
+    with open(source, newline="", encoding="utf-8") as f:
+        if source.lower().endswith(".csv"):
+            for row in csv.DictReader(f):
+                size = parse_size(row["size"]) if row.get("size") else default_size
+                tasks.append((os.path.join(base, row["path"]), size))
+        else:
+            for line in f:
+                if line.strip() and not line.startswith("#"):
+                    tasks.append((os.path.join(base, line.strip()), default_size))
+    return tasks
+
+
+def _output_dirs(tasks, out_dir):
+    """One output directory per image, named after the file and kept unique."""
+    seen = {}
+    dirs = []
+    for path, _ in tasks:
+        stem = os.path.splitext(os.path.basename(path))[0]
+        seen[stem] = seen.get(stem, 0) + 1
+        dirs.append(os.path.join(out_dir, stem if seen[stem] == 1 else f"{stem}_{seen[stem]}"))
+    return dirs
+
+
+def convert_image(path, mosaic_size, out_dir, options):
+    """Convert one image and write its preview, instructions and shopping list.
+
+    Runs in a worker process. Returns a result dict with the image path, output
+    directory, per-stage timings in seconds and the error message if it failed.
+    """
+    timings = {}
+    result = {"path": path, "out_dir": out_dir, "timings": timings, "error": None}
+    lego_colors = PALETTES[options["palette"]]
+    try:
+        start = time.perf_counter()
+        with Image.open(path) as source:
+            image = source.convert("RGB")
+        timings["load"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        mosaic_data, color_counts = create_mosaic(
+            image, mosaic_size, lego_colors, use_cache=False, metric=options["metric"],
+            dither=options["dither"], max_colors=options["max_colors"], raise_errors=True)
+        timings["generate"] = time.perf_counter() - start
+
+        os.makedirs(out_dir, exist_ok=True)
+        image_format = options["image_format"]
+        start = time.perf_counter()
+        preview = draw_mosaic(mosaic_data, options["preview_pixel_size"])
+        with open(os.path.join(out_dir, f"preview.{image_format}"), "wb") as f:
+            f.write(encode_image(preview, image_format))
+        timings["preview"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        instructions_format = options["instructions_format"]
+        if instructions_format in VECTOR_FORMATS:
+            data = vector_instructions(mosaic_data, instructions_format, options["instructions_pixel_size"],
+                                       color_counts=color_counts, lego_colors_used=lego_colors)
+        else:
+            data = encode_image(draw_instructions(mosaic_data, options["instructions_pixel_size"],
+                                                  color_counts, lego_colors), instructions_format)
+        with open(os.path.join(out_dir, f"instructions.{instructions_format}"), "wb") as f:
+            f.write(data)
+        timings["instructions"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        with open(os.path.join(out_dir, "shopping_list.csv"), "w", newline="", encoding="utf-8") as f:
+            f.write(shopping_list_csv(shopping_list(color_counts, lego_colors, mosaic_size)))
+        timings["shopping_list"] = time.perf_counter() - start
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+    return result
+
+
+def _convert_task(task):
+    return convert_image(*task)
+
+
+def run_batch(tasks, out_dir, options, workers=None):
+    """Convert all tasks across a process pool.
+
+    Args:
+        tasks: List of (image path, mosaic size) pairs.
+        out_dir: Directory that receives one subdirectory per image.
+        options: Conversion options (see the command-line arguments).
+        workers: Number of worker processes (defaults to the number of CPUs).
+
+    Yields:
+        Result dict of every image, in input order.
+    """
+    jobs = [(path, size, image_dir, options)
+            for (path, size), image_dir in zip(tasks, _output_dirs(tasks, out_dir))]
+    workers = min(workers or os.cpu_count() or 1, max(len(jobs), 1))
+    if workers <= 1:
+        for job in jobs:
+            yield _convert_task(job)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        yield from executor.map(_convert_task, jobs)
+
+
+def summarize(results, elapsed, workers):
+    """Throughput summary: image counts, images per second and per-stage timings."""
+    succeeded = [r for r in results if r["error"] is None]
+    stages = {}
+    for stage in STAGES:
+        times = [r["timings"][stage] for r in succeeded if stage in r["timings"]]
+        if times:
+            stages[stage] = {"total_s": sum(times), "mean_ms": 1000 * sum(times) / len(times),
+                             "max_ms": 1000 * max(times)}
+    return {
+        "images": len(results),
+        "succeeded": len(succeeded),
+        "failed": len(results) - len(succeeded),
+        "workers": workers,
+        "elapsed_s": elapsed,
+        "images_per_s": len(succeeded) / elapsed if elapsed > 0 else 0.0,
+        "stages": stages,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Convert a directory or manifest of images into LEGO mosaics.")
+    parser.add_argument("source", help="Directory of images, or a manifest (.csv with path[,size] "
+                                       "columns, or a text file with one path per line)")
+    parser.add_argument("--out", default="mosaics", help="Output directory (default: mosaics)")
+    parser.add_argument("--size", type=parse_size, default=48, help="Mosaic size, e.g. 48 or 64x48 (default: 48)")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes (default: number of CPUs)")
+    parser.add_argument("--palette", choices=sorted(PALETTES), default="square-available")
+    parser.add_argument("--metric", choices=METRICS, default="rgb")
+    parser.add_argument("--dither", choices=DITHER_MODES, default=None)
+    parser.add_argument("--max-colors", type=int, default=None)
+    parser.add_argument("--image-format", choices=IMAGE_FORMATS, default="png", help="Preview image format")
+    parser.add_argument("--instructions-format", choices=IMAGE_FORMATS + VECTOR_FORMATS, default="png")
+    parser.add_argument("--preview-pixel-size", type=int, default=10)
+    parser.add_argument("--instructions-pixel-size", type=int, default=24)
+    parser.add_argument("--summary", help="Also write the summary as JSON to this file")
+    args = parser.parse_args(argv)
+
+    tasks = collect_tasks(args.source, args.size)
+    if not tasks:
+        print(f"No images found in {args.source}", file=sys.stderr)
+        return 1
+    options = {
+        "palette": args.palette,
+        "metric": args.metric,
+        "dither": args.dither,
+        "max_colors": args.max_colors,
+        "image_format": args.image_format,
+        "instructions_format": args.instructions_format,
+        "preview_pixel_size": args.preview_pixel_size,
+        "instructions_pixel_size": args.instructions_pixel_size,
+    }
+    workers = min(args.workers or os.cpu_count() or 1, len(tasks))
+
+    results = []
+    start = time.perf_counter()
+    for result in run_batch(tasks, args.out, options, workers):
+        results.append(result)
+        status = "failed: " + result["error"] if result["error"] else "ok"
+        print(f"[{len(results)}/{len(tasks)}] {result['path']} {status}", flush=True)
+    summary = summarize(results, time.perf_counter() - start, workers)
+
+    print(f"\n{summary['succeeded']}/{summary['images']} images in {summary['elapsed_s']:.1f} s "
+          f"with {workers} workers ({summary['images_per_s']:.2f} images/s)")
+    for stage, timing in summary["stages"].items():
+        print(f"  {stage:<14} mean {timing['mean_ms']:8.1f} ms   max {timing['max_ms']:8.1f} ms   "
+              f"total {timing['total_s']:7.2f} s")
+    if args.summary:
+        with open(args.summary, "w") as f:
+            json.dump(summary, f, indent=2)
+    return 0 if summary["failed"] == 0 else 2
+
+
+if __name__ == "__main__":
+    sys.exit(main())
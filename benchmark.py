@@ -0,0 +1,275 @@
+"""Benchmark the mosaic pipeline across images, sizes, palettes and renderers.
+
+Every case generates a mosaic with create_mosaic and then times each renderer on it.
+Results are written as JSON (timings, peak memory and an output checksum per stage) so
+runs can be compared; a changed checksum means a stage now produces different output.
+
+Peak memory is measured with tracemalloc in one extra, untimed run per stage. It covers
+Python and NumPy allocations; Pillow's image buffers are allocated outside of it.
+
+Example:
+    python benchmark.py --out before.json
+    python benchmark.py --out after.json
+    python benchmark.py --compare before.json after.json
+"""
+import argparse
+import gc
+import hashlib
+import json
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+import numpy as np
+import PIL
+from PIL import Image
+
+from baseplates import BASEPLATE_SIZES
+from batch import PALETTES, parse_size
+from demo import INSTRUCTIONS_PIXEL_SIZE, PREVIEW_PIXEL_SIZE
+from utils import create_mosaic, draw_instructions, draw_mosaic, draw_mosaic_with_dots, instructions_img_to_bytes
+
+BENCHMARK_IMAGES = ("sample1.jpg", "sample2.jpeg", "sample3.jpg", "demo_image.jpeg")
+
+# Sizes beyond the standard baseplates, for large murals
+SYNTHETIC_SIZES = (192, 256, (384, 256))
+
+BENCHMARK_SIZES = tuple(entry["size"] for entry in BASEPLATE_SIZES) + SYNTHETIC_SIZES
+
+# Timed stages, in pipeline order
+STAGES = ("create_mosaic", "draw_mosaic", "draw_mosaic_with_dots", "draw_instructions",
+          "instructions_img_to_bytes")
+
+# Bump when the meaning of the results changes, so old files are not compared against new ones
+RESULTS_VERSION = 1
+
+
+def size_label(mosaic_size):
+    if isinstance(mosaic_size, (tuple, list)):
+        return f"{mosaic_size[0]}x{mosaic_size[1]}"
+    return str(mosaic_size)
+
+
+def checksum(output):
+    """Hex digest of a stage's output: a Mosaic, a PIL image or encoded bytes."""
+    hasher = hashlib.blake2b(digest_size=16)
+    if isinstance(output, Image.Image):
+        hasher.update(repr((output.mode, output.size)).encode())
+        hasher.update(output.tobytes())
+    elif isinstance(output, (bytes, bytearray)):
+        hasher.update(output)
+    else:
+        return output.digest
+    return hasher.hexdigest()
+
+
+def _describe(output):
+    if isinstance(output, Image.Image):
+        return {"width": output.width, "height": output.height}
+    if isinstance(output, (bytes, bytearray)):
+        return {"bytes": len(output)}
+    return {"width": output.width, "height": output.height, "colors": len(output.color_counts())}
+
+
+def measure(fn, repeats=3, warmup=1):
+    """Time ``fn()`` and measure its peak traced memory.
+
+    Returns:
+        (result of the last call, list of timings in milliseconds, peak memory in KiB).
+    """
+    for _ in range(warmup):
+        fn()
+    gc.collect()
+    times = []
+    result = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = fn()
+        times.append((time.perf_counter() - start) * 1000)
+
+    # Tracing slows allocations down, so memory gets its own run
+    del result
+    gc.collect()
+    tracemalloc.start()
+    try:
+        result = fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, times, peak / 1024
+
+
+def run_case(image, image_name, mosaic_size, palette_name, stages=STAGES, repeats=3, warmup=1):
+    """Benchmark every stage for one image, size and palette.
+
+    Returns:
+        List of result dicts, one per stage in ``stages``.
+    """
+    lego_colors = PALETTES[palette_name]
+    # Later stages need the earlier outputs even when they are not benchmarked themselves
+    steps = {
+        "create_mosaic": lambda out: create_mosaic(image, mosaic_size, lego_colors, use_cache=False,
+                                                   raise_errors=True),
+        "draw_mosaic": lambda out: draw_mosaic(out["create_mosaic"][0], PREVIEW_PIXEL_SIZE),
+        "draw_mosaic_with_dots": lambda out: draw_mosaic_with_dots(out["create_mosaic"][0], PREVIEW_PIXEL_SIZE),
+        "draw_instructions": lambda out: draw_instructions(out["create_mosaic"][0], INSTRUCTIONS_PIXEL_SIZE,
+                                                           out["create_mosaic"][1], lego_colors),
+        "instructions_img_to_bytes": lambda out: instructions_img_to_bytes(out["draw_instructions"]),
+    }
+    needed = {"create_mosaic"}
+    if "instructions_img_to_bytes" in stages:
+        needed.add("draw_instructions")
+
+    outputs = {}
+    results = []
+    for stage in STAGES:
+        if stage not in stages:
+            if stage in needed:
+                outputs[stage] = steps[stage](outputs)
+            continue
+        output, times, peak_kib = measure(lambda: steps[stage](outputs), repeats, warmup)
+        outputs[stage] = output
+        value = output[0] if stage == "create_mosaic" else output
+        results.append({
+            "image": image_name,
+            "size": size_label(mosaic_size),
+            "palette": palette_name,
+            "stage": stage,
+            "times_ms": [round(t, 3) for t in times],
+            "median_ms": round(statistics.median(times), 3),
+            "min_ms": round(min(times), 3),
+            "peak_kib": round(peak_kib, 1),
+            "checksum": checksum(value),
+            "output": _describe(value),
+        })
+    return results
+
+
+def run_benchmarks(images=BENCHMARK_IMAGES, sizes=BENCHMARK_SIZES, palettes=tuple(PALETTES), stages=STAGES,
+                   repeats=3, warmup=1, log=None):
+    """Run every combination of image, size and palette and return the results document."""
+    results = []
+    started = time.perf_counter()
+    for image_name in images:
+        with Image.open(image_name) as source:
+            image = source.convert("RGB")
+        for mosaic_size in sizes:
+            for palette_name in palettes:
+                case = run_case(image, image_name, mosaic_size, palette_name, stages, repeats, warmup)
+                results.extend(case)
+                if log:
+                    timings = "  ".join(f"{r['stage']} {r['median_ms']:.1f}" for r in case)
+                    log(f"{image_name} {size_label(mosaic_size)} {palette_name}: {timings} (ms)")
+    return {
+        "version": RESULTS_VERSION,
+        "meta": {
+            "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "processor": platform.processor() or platform.machine(),
+            "numpy": np.__version__,
+            "pillow": PIL.__version__,
+            "repeats": repeats,
+            "warmup": warmup,
+            "elapsed_s": round(time.perf_counter() - started, 2),
+        },
+        "results": results,
+    }
+
+
+def _case_key(result):
+    return result["image"], result["size"], result["palette"], result["stage"]
+
+
+def compare(baseline, current, threshold=0.10, min_delta_ms=1.0):
+    """Compare two results documents stage by stage.
+
+    A stage counts as a regression (or improvement) when its median time changed by more
+    than ``threshold`` (a fraction) and by more than ``min_delta_ms``, which keeps timer
+    noise on very fast stages out of the report.
+
+    Returns:
+        Dict with "regressions", "improvements", "checksum_changes" and "missing" lists.
+    """
+    old = {_case_key(r): r for r in baseline["results"]}
+    report = {"regressions": [], "improvements": [], "checksum_changes": [], "missing": []}
+    for result in current["results"]:
+        key = _case_key(result)
+        before = old.pop(key, None)
+        if before is None:
+            continue
+        if before["checksum"] != result["checksum"]:
+            report["checksum_changes"].append(key)
+        delta = result["median_ms"] - before["median_ms"]
+        ratio = result["median_ms"] / before["median_ms"] if before["median_ms"] > 0 else float("inf")
+        entry = {"case": key, "before_ms": before["median_ms"], "after_ms": result["median_ms"],
+                 "ratio": round(ratio, 3)}
+        if abs(delta) > min_delta_ms:
+            if ratio > 1 + threshold:
+                report["regressions"].append(entry)
+            elif ratio < 1 - threshold:
+                report["improvements"].append(entry)
+    report["missing"] = sorted(old)
+    return report
+
+
+def _print_comparison(report, threshold):
+    for title, entries in (("Regressions", report["regressions"]), ("Improvements", report["improvements"])):
+        print(f"{title} (median changed by more than {threshold:.0%}): {len(entries)}")
+        for entry in sorted(entries, key=lambda e: e["ratio"], reverse=title == "Regressions"):
+            print(f"  {' '.join(entry['case']):<60} {entry['before_ms']:10.1f} -> {entry['after_ms']:10.1f} ms"
+                  f"  x{entry['ratio']:.2f}")
+    print(f"Checksum changes: {len(report['checksum_changes'])}")
+    for key in report["checksum_changes"]:
+        print(f"  {' '.join(key)}")
+    if report["missing"]:
+        print(f"Cases only in the baseline: {len(report['missing'])}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark mosaic generation and rendering.")
+    parser.add_argument("--out", help="Write the results JSON here (default: standard output)")
+    parser.add_argument("--images", nargs="+", default=list(BENCHMARK_IMAGES))
+    parser.add_argument("--sizes", nargs="+", type=parse_size, default=list(BENCHMARK_SIZES),
+                        help="Mosaic sizes, e.g. 48 or 64x48 (default: every baseplate size plus "
+                             + ", ".join(map(size_label, SYNTHETIC_SIZES)) + ")")
+    parser.add_argument("--palettes", nargs="+", choices=sorted(PALETTES), default=list(PALETTES))
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=list(STAGES))
+    parser.add_argument("--repeats", type=int, default=3, help="Timed runs per stage (default: 3)")
+    parser.add_argument("--warmup", type=int, default=1, help="Untimed runs per stage first (default: 1)")
+    parser.add_argument("--compare", nargs=2, metavar=("BASELINE", "CURRENT"),
+                        help="Compare two results files instead of running the benchmarks")
+    parser.add_argument("--threshold", type=float, default=0.10,
+                        help="Relative change in median time reported by --compare (default: 0.10)")
+    args = parser.parse_args(argv)
+    if args.repeats < 1:
+        parser.error("--repeats must be at least 1")
+
+    if args.compare:
+        with open(args.compare[0]) as f:
+            baseline = json.load(f)
+        with open(args.compare[1]) as f:
+            current = json.load(f)
+        if baseline.get("version") != current.get("version"):
+            print("The results files come from different benchmark versions", file=sys.stderr)
+            return 2
+        report = compare(baseline, current, args.threshold)
+        _print_comparison(report, args.threshold)
+        return 1 if report["regressions"] or report["checksum_changes"] else 0
+
+    document = run_benchmarks(args.images, args.sizes, args.palettes, args.stages, args.repeats, args.warmup,
+                              log=lambda line: print(line, file=sys.stderr, flush=True))
+    output = json.dumps(document, indent=2)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,88 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """A thread-safe, process-wide LRU cache bounded by entry count and approximate memory.
+
+    Args:
+        max_entries: Maximum number of entries kept.
+        max_bytes: Maximum total size of the cached values, as reported by ``sizeof``.
+        sizeof: Callable returning the approximate size in bytes of a cached value.
+        ttl: Seconds after which an entry expires, or None to keep entries until evicted.
+    """
+
+    def __init__(self, max_entries=64, max_bytes=256 * 1024 * 1024, sizeof=None, ttl=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof or (lambda value: 0)
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        with self._lock:
+            return self._lookup(key) is not None
+
+    @property
+    def total_bytes(self):
+        return self._total_bytes
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._lookup(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._total_bytes -= old[1]
+            # Values larger than the whole budget are returned to the caller but not kept
+            if size > self.max_bytes:
+                return value
+            self._entries[key] = (value, size, time.monotonic())
+            self._total_bytes += size
+            self._evict()
+        return value
+
+    def get_or_create(self, key, factory):
+        """Return the cached value for ``key``, calling ``factory()`` to build it on a miss."""
+        sentinel = object()
+        value = self.get(key, sentinel)
+        if value is sentinel:
+            value = self.put(key, factory())
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._total_bytes = 0
+
+    def _lookup(self, key):
+        """Return the live entry for ``key``, dropping it if it has expired. Caller holds the lock."""
+        entry = self._entries.get(key)
+        if entry is not None and self.ttl is not None and time.monotonic() - entry[2] > self.ttl:
+            del self._entries[key]
+            self._total_bytes -= entry[1]
+            entry = None
+        return entry
+
+    def _evict(self):
+        while self._entries and (len(self._entries) > self.max_entries
+                                 or self._total_bytes > self.max_bytes):
+            _, (_, size, _) = self._entries.popitem(last=False)
+            self._total_bytes -= size
@@ -0,0 +1,215 @@
+import os
+import threading
+
+import numpy as np
+
+
+# Built lookup tables keyed by (palette key, bits), shared by all sessions in the process
+_LUT_CACHE = {}
+_LUT_LOCK = threading.Lock()
+
+# Number of lattice points matched per batch while building a table
+_BUILD_CHUNK_SIZE = 8192
+
+# Pixels refined per batch when matching
+_MATCH_CHUNK_SIZE = 65536
+
+# Squared-distance margin for keeping a bin candidate, far above float32 rounding error
+_CANDIDATE_SLACK = 1.0
+
+
+class ColorLUT:
+    """A quantized RGB lookup table mapping any color to its nearest palette index.
+
+    RGB space is split into ``2**bits`` bins per channel. Each bin stores the palette
+    index nearest to its center, so approximate matching is a single gather regardless of
+    palette size. Each bin also keeps the short, sorted list of palette colors that can be
+    nearest anywhere inside it; exact matching only compares a pixel against the
+    candidates of its bin, and bins with a single candidate need no comparison at all.
+
+    Attributes:
+        palette: The Palette the table was built for.
+        bits: Bits per channel used for binning.
+        table: Flat (2**(3*bits),) array of palette indices.
+        exact: Flat boolean array, True where the stored index is exact for the whole bin.
+        offsets: Flat (2**(3*bits) + 1,) array; the candidates of bin i are
+            ``candidates[offsets[i]:offsets[i + 1]]``.
+        candidates: Palette indices of all bins' candidates, concatenated.
+    """
+
+    def __init__(self, palette, bits=5, table=None, offsets=None, candidates=None):
+        if not 1 <= bits <= 8:
+            raise ValueError(f"bits must be between 1 and 8, got {bits}")
+        self.palette = palette
+        self.bits = bits
+        if table is None or offsets is None or candidates is None:
+            table, offsets, candidates = self._build()
+        self.table = table
+        self.offsets = offsets
+        self.candidates = candidates
+        self.exact = np.diff(offsets) == 1
+
+    @property
+    def bin_width(self):
+        return 256 >> self.bits
+
+    @property
+    def exact_fraction(self):
+        """Share of bins that never need refinement."""
+        return float(self.exact.mean())
+
+    @property
+    def mean_candidates(self):
+        """Average number of candidates compared for a pixel in an ambiguous bin."""
+        counts = np.diff(self.offsets)[~self.exact]
+        return float(counts.mean()) if len(counts) else 1.0
+
+    def _nearest(self, points):
+        """Nearest palette index for each point, matching Palette.match tie-breaking."""
+        colors = self.palette._match_rgb[self.palette._valid]
+        nearest = np.empty(len(points), dtype=self.palette.index_dtype)
+        for start in range(0, len(points), _BUILD_CHUNK_SIZE):
+            chunk = points[start:start + _BUILD_CHUNK_SIZE]
+            distances = ((chunk[:, None, :] - colors[None, :, :]) ** 2).sum(axis=2)
+            nearest[start:start + len(chunk)] = self.palette._valid[distances.argmin(axis=1)]
+        return nearest
+
+    def _candidate_lists(self, low, high):
+        """Palette colors that can be nearest to some point of each box [low, high].
+
+        A color is kept when its smallest possible distance to the box does not exceed
+        the largest possible distance of the color that is closest in the worst case.
+        Every color nearest to (or tied for nearest at) a point in the box passes this
+        test; the slack keeps colors that only win through float32 rounding as well.
+        """
+        colors = self.palette._match_rgb[self.palette._valid].astype(np.float64)
+        counts = np.empty(len(low), dtype=np.int64)
+        chunks = []
+        step = max(1, _BUILD_CHUNK_SIZE * 16 // len(colors))
+        for start in range(0, len(low), step):
+            lo = low[start:start + step, None, :]
+            hi = high[start:start + step, None, :]
+            gap = np.maximum(lo - colors, 0) + np.maximum(colors - hi, 0)
+            min_distance = (gap ** 2).sum(axis=2)
+            max_distance = (np.maximum(np.abs(colors - lo), np.abs(colors - hi)) ** 2).sum(axis=2)
+            keep = min_distance <= max_distance.min(axis=1, keepdims=True) + _CANDIDATE_SLACK
+            counts[start:start + step] = keep.sum(axis=1)
+            # nonzero walks row by row, so each bin's candidates stay in palette order
+            chunks.append(self.palette._valid[np.nonzero(keep)[1]])
+        offsets = np.zeros(len(low) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        return offsets, np.concatenate(chunks).astype(self.palette.index_dtype)
+
+    def _build(self):
+        bins = 1 << self.bits
+        width = self.bin_width
+        if len(self.palette._valid) == 0:
+            return (np.zeros(bins ** 3, dtype=self.palette.index_dtype),
+                    np.arange(bins ** 3 + 1, dtype=np.int64),
+                    np.zeros(bins ** 3, dtype=self.palette.index_dtype))
+
+        def lattice(values):
+            axes = np.meshgrid(values, values, values, indexing="ij")
+            return np.stack(axes, axis=-1).reshape(-1, 3).astype(np.float32)
+
+        # Each bin stores the color nearest to its center
+        table = self._nearest(lattice(np.arange(bins) * width + (width - 1) / 2))
+
+        # Bins are widened by half a unit so float inputs that round into the bin are covered
+        low = lattice(np.arange(bins) * width - 0.5).astype(np.float64)
+        offsets, candidates = self._candidate_lists(low, low + width)
+        return table, offsets, candidates
+
+    def _bin_indices(self, pixels):
+        shift = 8 - self.bits
+        quantized = np.clip(np.rint(pixels), 0, 255).astype(np.uint32) >> shift
+        return (quantized[:, 0] << (2 * self.bits)) | (quantized[:, 1] << self.bits) | quantized[:, 2]
+
+    def _refine(self, pixels, bin_indices):
+        """Nearest color among each pixel's bin candidates, with Palette.match's arithmetic."""
+        starts = self.offsets[bin_indices]
+        counts = self.offsets[bin_indices + 1] - starts
+        width = int(counts.max())
+        slots = np.arange(width)
+        valid = slots[None, :] < counts[:, None]
+        positions = np.where(valid, starts[:, None] + slots[None, :], starts[:, None])
+        candidates = self.candidates[positions]
+        colors = self.palette._match_rgb[candidates]
+        distances = ((pixels.astype(np.float32)[:, None, :] - colors) ** 2).sum(axis=2)
+        distances[~valid] = np.inf
+        return candidates[np.arange(len(pixels)), distances.argmin(axis=1)]
+
+    def match(self, pixel_data, exact=True):
+        """Map every pixel to a palette index with one table gather.
+
+        Args:
+            pixel_data: Array of shape (..., 3) holding RGB values.
+            exact: Refine pixels in ambiguous bins against the bin's candidates (and
+                out-of-range values with a full search), so the result equals Palette.match.
+
+        Returns:
+            Integer array with the shape of ``pixel_data`` minus its last axis.
+        """
+        pixel_data = np.asarray(pixel_data)
+        grid_shape = pixel_data.shape[:-1]
+        pixels = pixel_data.reshape(-1, 3)
+        bin_indices = self._bin_indices(pixels)
+        indices = self.table[bin_indices]
+
+        if exact:
+            refine = ~self.exact[bin_indices]
+            out_of_range = None
+            if pixels.dtype != np.uint8:
+                out_of_range = ((pixels < 0) | (pixels > 255)).any(axis=1)
+                refine &= ~out_of_range
+            for start in range(0, len(pixels), _MATCH_CHUNK_SIZE):
+                chunk = np.flatnonzero(refine[start:start + _MATCH_CHUNK_SIZE]) + start
+                if len(chunk):
+                    indices[chunk] = self._refine(pixels[chunk], bin_indices[chunk])
+            if out_of_range is not None and out_of_range.any():
+                indices[out_of_range] = self.palette.match(pixels[out_of_range])
+        return indices.reshape(grid_shape)
+
+    def save(self, path):
+        np.savez_compressed(path, table=self.table, offsets=self.offsets, candidates=self.candidates,
+                            palette_key=np.array(self.palette.key), bits=np.array(self.bits))
+
+    @classmethod
+    def load(cls, path, palette):
+        """Load a table saved with save(), or return None if it is missing or for another palette."""
+        try:
+            with np.load(path) as data:
+                if str(data["palette_key"]) != palette.key:
+                    return None
+                return cls(palette, int(data["bits"]), data["table"], data["offsets"], data["candidates"])
+        except (OSError, KeyError, ValueError):
+            return None
+
+
+def get_color_lut(palette, bits=5, cache_dir=None):
+    """Return the lookup table for a palette, building it once per process.
+
+    Args:
+        palette: Compiled Palette.
+        bits: Bits per channel (5 gives 32x32x32 bins, 6 gives 64x64x64).
+        cache_dir: Optional directory where tables are stored and reloaded across restarts.
+    """
+    key = (palette.key, bits)
+    with _LUT_LOCK:
+        lut = _LUT_CACHE.get(key)
+        if lut is not None:
+            return lut
+
+        path = None
+        if cache_dir:
+            path = os.path.join(cache_dir, f"lut_{palette.key}_{bits}.npz")
+            lut = ColorLUT.load(path, palette)
+
+        if lut is None:
+            lut = ColorLUT(palette, bits)
+            if path:
+                os.makedirs(cache_dir, exist_ok=True)
+                lut.save(path)
+
+        _LUT_CACHE[key] = lut
+        return lut
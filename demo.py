@@ -0,0 +1,148 @@
+import io
+import os
+
+import numpy as np
+from PIL import Image
+
+from baseplates import BASEPLATE_SIZES
+from lego_colors_square_available import LEGO_COLORS_SQUARE_AVAILABLE
+from mosaic import Mosaic
+from palette import get_palette
+from utils import DEFAULT_ENCODING, create_mosaic, image_digest, prime_render_cache, render_cached
+
+DEMO_IMAGE_PATH = "demo_image.jpeg"
+DEMO_ARTIFACT_PATH = "demo_mosaics.npz"
+
+# Pixel sizes the app renders by default: the preview zoom slider and the instructions
+PREVIEW_PIXEL_SIZE = 10
+INSTRUCTIONS_PIXEL_SIZE = 24
+
+
+class DemoMosaic:
+    """A precomputed demo mosaic together with its encoded preview and instructions."""
+
+    def __init__(self, mosaic, color_counts, preview_png, instructions_png):
+        self.mosaic = mosaic
+        self.color_counts = color_counts
+        self.preview_png = preview_png
+        self.instructions_png = instructions_png
+
+
+def gradient_image(size=300):
+    """Create the fallback demo image: a red/green/blue gradient."""
+    x = np.arange(size)[None, :]
+    y = np.arange(size)[:, None]
+    r = np.broadcast_to(255 * x // size, (size, size))
+    g = np.broadcast_to(255 * y // size, (size, size))
+    b = (255 * (1 - (x + y) / (2 * size))).astype(np.int64)
+    return Image.fromarray(np.stack([r, g, b], axis=-1).astype(np.uint8), 'RGB')
+
+
+def load_demo_image(path=DEMO_IMAGE_PATH):
+    """Open the demo image, falling back to a generated gradient.
+
+    Returns:
+        (image, loaded_from_file) tuple.
+    """
+    try:
+        image = Image.open(path)
+        image.load()
+        return image, True
+    except (FileNotFoundError, IOError):
+        return gradient_image(), False
+
+
+def _prime(demo, lego_colors):
+    """Seed the render cache so the app's first preview/instructions render is a cache hit."""
+    # Downloads may be palette-mode PNGs; the cached views are RGB like freshly rendered ones
+    preview = Image.open(io.BytesIO(demo.preview_png)).convert("RGB")
+    prime_render_cache("mosaic", demo.mosaic, PREVIEW_PIXEL_SIZE, preview, demo.preview_png)
+
+    instructions = Image.open(io.BytesIO(demo.instructions_png)).convert("RGB")
+    prime_render_cache("instructions", demo.mosaic, INSTRUCTIONS_PIXEL_SIZE, instructions,
+                       demo.instructions_png, color_counts=demo.color_counts,
+                       lego_colors_used=lego_colors)
+
+
+def build_demo_mosaics(image, sizes, lego_colors):
+    """Generate and render the demo mosaic for every size.
+
+    Returns:
+        Dict mapping mosaic size to DemoMosaic.
+    """
+    demos = {}
+    for size in sizes:
+        mosaic, color_counts = create_mosaic(image, size, lego_colors)
+        if mosaic is None:
+            continue
+        _, preview_png = render_cached("mosaic", mosaic, PREVIEW_PIXEL_SIZE)
+        _, instructions_png = render_cached("instructions", mosaic, INSTRUCTIONS_PIXEL_SIZE,
+                                            color_counts=color_counts,
+                                            lego_colors_used=lego_colors)
+        demos[size] = DemoMosaic(mosaic, color_counts, preview_png, instructions_png)
+    return demos
+
+
+def save_demo_artifact(demos, image, lego_colors, path=DEMO_ARTIFACT_PATH):
+    """Write precomputed demo mosaics to an .npz artifact."""
+    arrays = {
+        "image_digest": np.array(image_digest(image)),
+        "palette_key": np.array(get_palette(lego_colors).key),
+        "pixel_sizes": np.array([PREVIEW_PIXEL_SIZE, INSTRUCTIONS_PIXEL_SIZE]),
+        "encoding": np.array(repr(DEFAULT_ENCODING)),
+        "sizes": np.array(sorted(demos)),
+    }
+    for size, demo in demos.items():
+        arrays[f"indices_{size}"] = demo.mosaic.indices
+        arrays[f"preview_{size}"] = np.frombuffer(demo.preview_png, dtype=np.uint8)
+        arrays[f"instructions_{size}"] = np.frombuffer(demo.instructions_png, dtype=np.uint8)
+    np.savez(path, **arrays)
+
+
+def load_demo_artifact(image, sizes, lego_colors, path=DEMO_ARTIFACT_PATH):
+    """Load precomputed demo mosaics, or return None if the artifact is missing or stale."""
+    if not os.path.exists(path):
+        return None
+
+    palette = get_palette(lego_colors)
+    try:
+        with np.load(path) as data:
+            if (str(data["palette_key"]) != palette.key
+                    or str(data["image_digest"]) != image_digest(image)
+                    or data["pixel_sizes"].tolist() != [PREVIEW_PIXEL_SIZE, INSTRUCTIONS_PIXEL_SIZE]
+                    or str(data["encoding"]) != repr(DEFAULT_ENCODING)
+                    or not set(sizes) <= set(data["sizes"].tolist())):
+                return None
+
+            demos = {}
+            for size in sizes:
+                mosaic = Mosaic(data[f"indices_{size}"], palette)
+                demos[size] = DemoMosaic(mosaic, mosaic.color_counts(),
+                                         data[f"preview_{size}"].tobytes(),
+                                         data[f"instructions_{size}"].tobytes())
+            return demos
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def load_demo_mosaics(image, sizes, lego_colors, path=DEMO_ARTIFACT_PATH):
+    """Return demo mosaics for all sizes, from the on-disk artifact if valid, else computed.
+
+    Either way the render cache is primed with the encoded previews and instructions.
+    """
+    demos = load_demo_artifact(image, sizes, lego_colors, path)
+    if demos is None:
+        return build_demo_mosaics(image, sizes, lego_colors)
+
+    for demo in demos.values():
+        _prime(demo, lego_colors)
+    return demos
+
+
+if __name__ == "__main__":
+    # Precompute the demo artifact: python demo.py
+    demo_image, _ = load_demo_image()
+    demo_sizes = [s["size"] for s in BASEPLATE_SIZES]
+    demo_mosaics = build_demo_mosaics(demo_image, demo_sizes, LEGO_COLORS_SQUARE_AVAILABLE)
+    save_demo_artifact(demo_mosaics, demo_image, LEGO_COLORS_SQUARE_AVAILABLE)
+    print(f"Wrote {DEMO_ARTIFACT_PATH} with {len(demo_mosaics)} demo mosaics")
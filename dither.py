@@ -0,0 +1,89 @@
+import numpy as np
+
+
+# Dithering modes accepted by create_mosaic (None disables dithering)
+DITHER_MODES = ("ordered", "floyd-steinberg")
+
+
+def bayer_matrix(size):
+    """Return the normalized size x size Bayer threshold matrix (values in [0, 1))."""
+    matrix = np.zeros((1, 1), dtype=np.int64)
+    while matrix.shape[0] < size:
+        matrix = np.block([[4 * matrix, 4 * matrix + 2],
+                           [4 * matrix + 3, 4 * matrix + 1]])
+    return (matrix + 0.5) / matrix.size
+
+
+def palette_spread(palette):
+    """Typical distance between a palette color and its nearest neighbour in RGB."""
+    colors = palette._match_rgb[palette._valid].astype(np.float64)
+    if len(colors) < 2:
+        return 0.0
+    distances = np.sqrt(((colors[:, None, :] - colors[None, :, :]) ** 2).sum(axis=2))
+    np.fill_diagonal(distances, np.inf)
+    return float(np.median(distances.min(axis=1)))
+
+
+def ordered_dither(pixel_data, palette, matrix_size=4, spread=None):
+    """Offset an (H, W, 3) float image by a tiled Bayer pattern before palette matching.
+
+    Args:
+        pixel_data: RGB image array.
+        palette: Compiled Palette; its color spacing sets the default offset amplitude.
+        matrix_size: Bayer matrix size (a power of two).
+        spread: Peak-to-peak offset in RGB units (defaults to the palette spread).
+
+    Returns:
+        Float32 array of the same shape, clipped to [0, 255].
+    """
+    pixels = np.asarray(pixel_data, dtype=np.float32)
+    height, width = pixels.shape[:2]
+    if spread is None:
+        spread = palette_spread(palette)
+
+    thresholds = bayer_matrix(matrix_size) - 0.5
+    reps = (-(-height // matrix_size), -(-width // matrix_size))
+    offsets = np.tile(thresholds, reps)[:height, :width].astype(np.float32) * spread
+    return np.clip(pixels + offsets[:, :, None], 0, 255)
+
+
+def error_diffusion(pixel_data, palette, match):
+    """Floyd-Steinberg dither an (H, W, 3) image and return its palette index grid.
+
+    Pixel (y, x) only receives error from (y, x-1) and the three pixels above it, so all
+    pixels on a wavefront x + 2y = t can be quantized together. This processes the image in
+    W + 2H vectorized steps and gives the same result as the pixel-by-pixel scan.
+
+    Args:
+        pixel_data: RGB image array.
+        palette: Compiled Palette used to compute the quantization error.
+        match: Callable mapping an (N, 3) array of RGB values to palette indices.
+    """
+    work = np.array(pixel_data, dtype=np.float32)[:, :, :3]
+    height, width = work.shape[:2]
+    indices = np.zeros((height, width), dtype=palette.index_dtype)
+    colors = palette._match_rgb
+
+    # Precompute the coordinates of each wavefront
+    all_y, all_x = np.divmod(np.arange(height * width), width)
+    wave = all_x + 2 * all_y
+    order = np.argsort(wave, kind="stable")
+    boundaries = np.searchsorted(wave[order], np.arange(wave.max() + 2))
+
+    for t in range(len(boundaries) - 1):
+        members = order[boundaries[t]:boundaries[t + 1]]
+        if len(members) == 0:
+            continue
+        ys, xs = all_y[members], all_x[members]
+
+        values = np.clip(work[ys, xs], 0, 255)
+        chosen = match(values)
+        indices[ys, xs] = chosen
+        error = values - colors[chosen]
+
+        # Distribute the error: 7/16 right, 3/16 below-left, 5/16 below, 1/16 below-right
+        for dy, dx, weight in ((0, 1, 7 / 16), (1, -1, 3 / 16), (1, 0, 5 / 16), (1, 1, 1 / 16)):
+            ny, nx = ys + dy, xs + dx
+            inside = (ny < height) & (nx >= 0) & (nx < width)
+            work[ny[inside], nx[inside]] += error[inside] * weight
+    return indices
@@ -0,0 +1,73 @@
+import io
+
+import numpy as np
+from PIL import Image, features
+
+
+# Download formats accepted by encode_image
+IMAGE_FORMATS = ("png", "webp")
+
+IMAGE_MIME_TYPES = {"png": "image/png", "webp": "image/webp"}
+
+# zlib level for PNG output (0-9); palette-mode PNGs are small even at low levels
+PNG_COMPRESS_LEVEL = 6
+
+# WebP lossless effort (0-6); higher levels are several times slower on large images
+WEBP_METHOD = 0
+
+
+def webp_available():
+    """True if the installed Pillow can write WebP."""
+    return features.check("webp")
+
+
+def to_palette_image(img, max_colors=256):
+    """Losslessly convert an image with at most ``max_colors`` colors to palette ("P") mode.
+
+    Returns None if the image has more colors than a palette can hold.
+    """
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    colors = img.getcolors(max_colors)
+    if colors is None:
+        return None
+
+    # Map every pixel to its exact palette entry by the packed 24-bit color value
+    palette = np.array([color for _, color in colors], dtype=np.uint8)
+    packed_palette = (palette[:, 0].astype(np.uint32) << 16) | (palette[:, 1].astype(np.uint32) << 8) | palette[:, 2]
+    order = np.argsort(packed_palette)
+    pixels = np.asarray(img)
+    packed = (pixels[..., 0].astype(np.uint32) << 16) | (pixels[..., 1].astype(np.uint32) << 8) | pixels[..., 2]
+    indices = order[np.searchsorted(packed_palette[order], packed)].astype(np.uint8)
+
+    palette_img = Image.fromarray(indices, "P")
+    palette_img.putpalette(palette.ravel().tolist())
+    return palette_img
+
+
+def encode_image(img, fmt="png", palette_mode=True, compress_level=None):
+    """Encode an image for download.
+
+    Args:
+        img: PIL image.
+        fmt: One of IMAGE_FORMATS; WebP is always lossless.
+        palette_mode: Write PNGs with at most 256 colors as palette images, which are
+            several times smaller and faster to compress than RGB.
+        compress_level: zlib level for PNG (defaults to PNG_COMPRESS_LEVEL).
+
+    Returns:
+        The encoded bytes.
+    """
+    if fmt not in IMAGE_FORMATS:
+        raise ValueError(f"Unknown image format: {fmt}")
+
+    buf = io.BytesIO()
+    if fmt == "webp":
+        img.save(buf, format="WEBP", lossless=True, method=WEBP_METHOD)
+        return buf.getvalue()
+
+    if palette_mode:
+        img = to_palette_image(img) or img
+    level = PNG_COMPRESS_LEVEL if compress_level is None else compress_level
+    img.save(buf, format="PNG", compress_level=level)
+    return buf.getvalue()
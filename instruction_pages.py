@@ -0,0 +1,184 @@
+import io
+import multiprocessing
+import os
+import threading
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from PIL import Image
+
+from baseplates import BaseplateLayout, plan_baseplates
+from cache import LRUCache
+from encoding import encode_image
+from mosaic import Mosaic, as_mosaic
+from palette import Palette
+from utils import draw_instructions
+
+# Output formats accepted by instruction_bundle
+PAGE_BUNDLE_FORMATS = ("zip", "pdf")
+
+# Mosaics with fewer pages than this are rendered in the calling process, where handing
+# them to the pool would cost more than it saves
+_MIN_PARALLEL_PAGES = 4
+
+# Bundles keyed by (mosaic digest, pixel size, plate size, numbering, format)
+_BUNDLE_CACHE = LRUCache(max_entries=16, max_bytes=256 * 1024 * 1024, sizeof=len)
+
+# Long-lived pools by worker count. Workers are spawned rather than forked, since the
+# Streamlit server that starts them runs many threads.
+_POOLS = {}
+_POOLS_LOCK = threading.Lock()
+
+# Palettes compiled in a pool worker, by palette key; only used inside worker processes
+_WORKER_PALETTES = LRUCache(max_entries=8)
+
+
+def _worker_palette(palette_key, lego_colors):
+    return _WORKER_PALETTES.get_or_create(palette_key, lambda: Palette(lego_colors))
+
+
+def _render_page(task, palette):
+    """Draw and PNG-encode one page."""
+    row, col, indices, pixel_size, color_numbers = task
+    page = Mosaic(indices, palette)
+    image = draw_instructions(page, pixel_size, page.color_counts(), palette.colors,
+                              color_numbers=color_numbers)
+    return row, col, encode_image(image)
+
+
+def _render_page_in_worker(task, palette_key, lego_colors):
+    return _render_page(task, _worker_palette(palette_key, lego_colors))
+
+
+def _get_pool(workers):
+    with _POOLS_LOCK:
+        pool = _POOLS.get(workers)
+        if pool is None:
+            pool = _POOLS[workers] = ProcessPoolExecutor(
+                max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        return pool
+
+
+def _discard_pool(workers, pool):
+    with _POOLS_LOCK:
+        if _POOLS.get(workers) is pool:
+            del _POOLS[workers]
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def page_layout(mosaic_data, plate_size=None):
+    """Baseplate layout the pages follow: ``plate_size`` studs per page, or the planned plates."""
+    if plate_size is None:
+        return plan_baseplates(mosaic_data.width, mosaic_data.height)
+    return BaseplateLayout(mosaic_data.width, mosaic_data.height, plate_size)
+
+
+def page_file_name(row, col):
+    """File name of the page for the baseplate at ``row``, ``col`` within a ZIP bundle."""
+    return f"instructions_row{row + 1:02d}_col{col + 1:02d}.png"
+
+
+def _page_tasks(mosaic_data, pixel_size, plate_size, color_counts):
+    if color_counts is None:
+        color_counts = mosaic_data.color_counts()
+    color_numbers = {color_name: i + 1 for i, color_name in enumerate(color_counts)}
+    return [(row, col, mosaic_data.indices[top:bottom, left:right], pixel_size, color_numbers)
+            for row, col, (top, left, bottom, right) in page_layout(mosaic_data, plate_size).tiles()]
+
+
+def iter_instruction_pages(mosaic_data, pixel_size=24, plate_size=None, color_counts=None):
+    """Render the per-baseplate pages one at a time in the calling process.
+
+    Arguments match render_instruction_pages. Only one page is held at a time, so callers
+    can stream the pages out while later ones are still being drawn.
+
+    Yields:
+        (row, column, png_bytes) tuples in row-major page order.
+    """
+    mosaic_data = as_mosaic(mosaic_data)
+    for task in _page_tasks(mosaic_data, pixel_size, plate_size, color_counts):
+        yield _render_page(task, mosaic_data.palette)
+
+
+def render_instruction_pages(mosaic_data, pixel_size=24, plate_size=None, color_counts=None,
+                             workers=None):
+    """Render the building instructions as one page per baseplate, in parallel.
+
+    Every page shows one baseplate of the mosaic with a legend of the colors it uses.
+    Colors keep the numbers of the full instructions on every page. Pages are drawn and
+    encoded independently across a long-lived process pool shared by all sessions.
+
+    Args:
+        mosaic_data: Mosaic (or legacy nested-list mosaic).
+        pixel_size: Pixels per stud.
+        plate_size: Studs per page side (defaults to the planned baseplate size).
+        color_counts: Color counts of the whole mosaic, which set the color numbering
+            (defaults to the mosaic's own counts).
+        workers: Number of worker processes (defaults to the number of CPUs; 1 renders
+            in the calling process).
+
+    Returns:
+        List of (row, column, png_bytes) tuples in row-major page order.
+    """
+    mosaic_data = as_mosaic(mosaic_data)
+    tasks = _page_tasks(mosaic_data, pixel_size, plate_size, color_counts)
+    workers = workers or os.cpu_count() or 1
+    workers = min(workers, len(tasks))
+
+    palette = mosaic_data.palette
+    if workers <= 1 or len(tasks) < _MIN_PARALLEL_PAGES:
+        return [_render_page(task, palette) for task in tasks]
+
+    pool = _get_pool(workers)
+    chunksize = max(1, len(tasks) // (workers * 4))
+    try:
+        return list(pool.map(_render_page_in_worker, tasks, [palette.key] * len(tasks),
+                             [palette.colors] * len(tasks), chunksize=chunksize))
+    except BrokenProcessPool:
+        # A worker died (e.g. out of memory); start a fresh pool for the next request
+        _discard_pool(workers, pool)
+        raise
+
+
+def write_pages_zip(pages, fileobj):
+    """Write (row, column, png_bytes) pages to ``fileobj`` as a ZIP, one page at a time.
+
+    ``fileobj`` does not need to be seekable, so the ZIP can be written straight to a socket.
+    """
+    # PNG data is already compressed, so the pages are stored as is
+    with zipfile.ZipFile(fileobj, "w", compression=zipfile.ZIP_STORED) as archive:
+        for row, col, png in pages:
+            archive.writestr(page_file_name(row, col), png)
+
+
+def bundle_pages(pages, fmt="zip"):
+    """Bundle rendered pages into a ZIP of PNG files or a multi-page PDF.
+
+    Args:
+        pages: List of (row, column, png_bytes) tuples as returned by render_instruction_pages.
+        fmt: One of PAGE_BUNDLE_FORMATS.
+
+    Returns:
+        The bundle as bytes.
+    """
+    if fmt not in PAGE_BUNDLE_FORMATS:
+        raise ValueError(f"Unknown page bundle format: {fmt}")
+
+    buffer = io.BytesIO()
+    if fmt == "zip":
+        write_pages_zip(pages, buffer)
+    else:
+        images = [Image.open(io.BytesIO(png)) for _, _, png in pages]
+        images[0].save(buffer, format="PDF", save_all=True, append_images=images[1:])
+    return buffer.getvalue()
+
+
+def instruction_bundle(mosaic_data, pixel_size=24, fmt="zip", plate_size=None, color_counts=None,
+                       workers=None):
+    """Return the per-baseplate instruction pages of a mosaic as a ZIP or PDF, cached by content."""
+    mosaic_data = as_mosaic(mosaic_data)
+    numbering = tuple(color_counts) if color_counts is not None else None
+    key = (mosaic_data.digest, pixel_size, plate_size, numbering, fmt)
+    return _BUNDLE_CACHE.get_or_create(key, lambda: bundle_pages(
+        render_instruction_pages(mosaic_data, pixel_size, plate_size, color_counts, workers), fmt))
@@ -0,0 +1,163 @@
+import time
+
+import numpy as np
+
+
+def _color_costs(pixels, palette, metric):
+    """Distance from every pixel to every palette color, as an (N, colors) float32 array."""
+    if metric == "lab":
+        from palette import rgb_to_lab
+        coords, colors = rgb_to_lab(pixels), palette.lab
+    elif metric == "rgb":
+        coords, colors = pixels.astype(np.float64), palette._match_rgb.astype(np.float64)
+    else:
+        raise ValueError(f"Unsupported metric for inventory solving: {metric}")
+
+    # |p - c|^2 = |p|^2 - 2 p.c + |c|^2, computed without the (N, colors, 3) buffer
+    squared = ((coords ** 2).sum(axis=1)[:, None] - 2 * coords @ colors.T
+               + (colors ** 2).sum(axis=1)[None, :])
+    return np.sqrt(np.maximum(squared, 0)).astype(np.float32)
+
+
+def _accept(targets, priority, spare):
+    """Accept moves in priority order (lowest first) without exceeding any target's spare room."""
+    order = np.lexsort((priority, targets))
+    sorted_targets = targets[order]
+    rank = np.arange(len(order)) - np.searchsorted(sorted_targets, sorted_targets, side="left")
+    accepted = np.zeros(len(targets), dtype=bool)
+    accepted[order[rank < spare[sorted_targets]]] = True
+    return accepted
+
+
+def _repair(assign, costs, capacity):
+    """Move studs out of over-used colors, cheapest regret first, until every limit holds."""
+    rows = np.arange(len(assign))
+    iterations = 0
+    while True:
+        counts = np.bincount(assign, minlength=costs.shape[1])
+        excess = counts - capacity
+        if not (excess > 0).any():
+            return iterations
+        iterations += 1
+
+        spare = np.maximum(capacity - counts, 0)
+        candidates = rows[excess[assign] > 0]
+        alt_costs = np.where(spare[None, :] > 0, costs[candidates], np.inf)
+        alternatives = alt_costs.argmin(axis=1)
+        regret = alt_costs[np.arange(len(candidates)), alternatives] - costs[candidates, assign[candidates]]
+
+        # Only the excess of each over-used color has to leave; pick the cheapest studs
+        sources = assign[candidates]
+        order = np.lexsort((regret, sources))
+        sorted_sources = sources[order]
+        rank = np.arange(len(order)) - np.searchsorted(sorted_sources, sorted_sources, side="left")
+        leaving = order[rank < excess[sorted_sources]]
+
+        accepted = _accept(alternatives[leaving], regret[leaving], spare)
+        moved = candidates[leaving[accepted]]
+        assign[moved] = alternatives[leaving[accepted]]
+
+
+def _improve(assign, costs, capacity, passes):
+    """Lower the total error with capacity-preserving moves and pairwise color swaps."""
+    rows = np.arange(len(assign))
+    for _ in range(passes):
+        improved = False
+
+        # Single moves into colors that still have room
+        counts = np.bincount(assign, minlength=costs.shape[1])
+        spare = np.maximum(capacity - counts, 0)
+        open_costs = np.where(spare[None, :] > 0, costs, np.inf)
+        best = open_costs.argmin(axis=1)
+        gain = costs[rows, assign] - open_costs[rows, best]
+        movers = np.flatnonzero(gain > 1e-6)
+        if len(movers):
+            accepted = _accept(best[movers], -gain[movers], spare)
+            assign[movers[accepted]] = best[movers[accepted]]
+            improved |= bool(accepted.any())
+
+        # Swaps between two colors keep both counts unchanged
+        order = np.argsort(assign, kind="stable")
+        bounds = np.searchsorted(assign[order], np.arange(costs.shape[1] + 1))
+        members = [order[bounds[c]:bounds[c + 1]] for c in range(costs.shape[1])]
+        used = [c for c in range(costs.shape[1]) if len(members[c])]
+        for i, a in enumerate(used):
+            for b in used[i + 1:]:
+                in_a, in_b = members[a], members[b]
+                gain_ab = costs[in_a, a] - costs[in_a, b]
+                gain_ba = costs[in_b, b] - costs[in_b, a]
+                top_ab = np.argsort(-gain_ab)
+                top_ba = np.argsort(-gain_ba)
+                n = min(len(in_a), len(in_b))
+                combined = gain_ab[top_ab[:n]] + gain_ba[top_ba[:n]]
+                swaps = int((combined > 1e-6).sum())
+                if swaps:
+                    moved_ab, moved_ba = in_a[top_ab[:swaps]], in_b[top_ba[:swaps]]
+                    assign[moved_ab] = b
+                    assign[moved_ba] = a
+                    members[a] = np.concatenate([np.delete(in_a, top_ab[:swaps]), moved_ba])
+                    members[b] = np.concatenate([np.delete(in_b, top_ba[:swaps]), moved_ab])
+                    improved = True
+        if not improved:
+            break
+
+
+def assign_with_inventory(pixel_data, palette, stock, strict=False, metric="rgb", passes=2):
+    """Assign studs to colors, minimizing total color error within per-color stock limits.
+
+    Greedy with repair: every stud starts on its nearest color, studs are moved out of
+    over-used colors in order of least added error, and a few improvement passes of
+    single moves and pairwise swaps then reduce the error further.
+
+    Args:
+        pixel_data: Array of shape (..., 3) holding RGB values.
+        palette: Compiled Palette; limits are matched on its elementIds.
+        stock: Dict mapping elementId to the number of plates available.
+        strict: If True, colors missing from ``stock`` are unavailable; otherwise unlimited.
+        metric: Distance used for the error, "rgb" or "lab".
+        passes: Maximum number of improvement passes.
+
+    Returns:
+        (indices, stats) tuple: an index array with the shape of ``pixel_data`` minus its
+        last axis, and a dict with solve_time, total_error, unconstrained_error,
+        moved_studs and repair_iterations.
+
+    Raises:
+        ValueError: If the stock cannot cover every stud.
+    """
+    start = time.perf_counter()
+    pixel_data = np.asarray(pixel_data)
+    grid_shape = pixel_data.shape[:-1]
+    pixels = pixel_data.reshape(-1, 3)
+
+    capacity = np.full(len(palette), 0.0 if strict else np.inf)
+    for element_id, quantity in stock.items():
+        index = palette.element_to_index.get(element_id)
+        if index is None:
+            # Accept elementIds given as strings, e.g. read from a CSV file
+            index = palette.element_to_index.get(int(element_id)) if str(element_id).isdigit() else None
+        if index is not None:
+            capacity[index] = max(int(quantity), 0)
+    unusable = np.ones(len(palette), dtype=bool)
+    unusable[palette._valid] = False
+    capacity[unusable] = 0
+    if capacity.sum() < len(pixels):
+        raise ValueError(f"Stock covers only {int(capacity.sum())} of {len(pixels)} studs")
+
+    costs = _color_costs(pixels, palette, metric)
+    costs[:, unusable] = np.inf
+    rows = np.arange(len(pixels))
+    nearest = costs.argmin(axis=1)
+    assign = nearest.copy()
+
+    iterations = _repair(assign, costs, capacity)
+    _improve(assign, costs, capacity, passes)
+
+    stats = {
+        "solve_time": time.perf_counter() - start,
+        "total_error": float(costs[rows, assign].sum()),
+        "unconstrained_error": float(costs[rows, nearest].sum()),
+        "moved_studs": int((assign != nearest).sum()),
+        "repair_iterations": iterations,
+    }
+    return assign.astype(palette.index_dtype).reshape(grid_shape), stats
@@ -0,0 +1,135 @@
+import os
+import threading
+from concurrent.futures import CancelledError, ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+
+class JobCancelled(Exception):
+    """Raised inside a job's work function once the job has been cancelled."""
+
+
+class Job:
+    """A unit of background work with progress reporting and cooperative cancellation.
+
+    The work function receives the job and should call ``job.report(stage, fraction)``
+    between steps; report() raises JobCancelled once the job is cancelled, which stops
+    the work at the next step.
+
+    Attributes:
+        key: Identity of the work; identical in-flight jobs share one Job.
+        stage: Description of the current step.
+        progress: Fraction of the work done, between 0 and 1.
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.stage = "Queued"
+        self.progress = 0.0
+        self.future = None
+        self._subscribers = 1
+        self._cancelled = threading.Event()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    @property
+    def done(self):
+        return self.future is not None and self.future.done()
+
+    def report(self, stage, fraction):
+        """Record progress; raises JobCancelled if the job has been cancelled."""
+        if self._cancelled.is_set():
+            raise JobCancelled(self.key)
+        self.stage = stage
+        self.progress = min(max(float(fraction), 0.0), 1.0)
+
+    def wait(self, timeout=None):
+        """Wait up to ``timeout`` seconds; True once the job has finished."""
+        try:
+            self.future.exception(timeout)
+        except CancelledError:
+            pass
+        except FutureTimeout:
+            return False
+        return True
+
+    def result(self):
+        """Return the work function's result, re-raising its exception.
+
+        Raises:
+            JobCancelled: If the job was cancelled.
+        """
+        try:
+            return self.future.result()
+        except CancelledError:
+            raise JobCancelled(self.key) from None
+
+
+class JobQueue:
+    """Process-wide pool of worker threads running Jobs.
+
+    Submitting work whose key matches a job that is still queued or running returns that
+    job instead of starting the work again. Each submission subscribes to the job, and a
+    job is only cancelled once every subscriber has released it.
+
+    Args:
+        max_workers: Number of worker threads (defaults to the number of CPUs).
+    """
+
+    def __init__(self, max_workers=None):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers or os.cpu_count() or 1,
+                                            thread_name_prefix="mosaic-job")
+        self._jobs = {}
+        # Re-entrant: a job that is already finished runs its done callback inside submit()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._jobs)
+
+    def submit(self, key, fn, *args, **kwargs):
+        """Run ``fn(job, *args, **kwargs)`` in the background, or join an identical in-flight job."""
+        with self._lock:
+            job = self._jobs.get(key)
+            if job is not None and not job.cancelled:
+                job._subscribers += 1
+                return job
+
+            job = Job(key)
+            self._jobs[key] = job
+            job.future = self._executor.submit(fn, job, *args, **kwargs)
+            job.future.add_done_callback(lambda _: self._forget(job))
+            return job
+
+    def release(self, job):
+        """Drop one subscription to ``job``, cancelling it when nobody is waiting for it anymore."""
+        if job is None:
+            return
+        with self._lock:
+            job._subscribers -= 1
+            if job._subscribers > 0 or job.done:
+                return
+            job._cancelled.set()
+            job.stage = "Cancelled"
+            if self._jobs.get(job.key) is job:
+                del self._jobs[job.key]
+        # Jobs that have not started yet never run; running jobs stop at their next report()
+        job.future.cancel()
+
+    def _forget(self, job):
+        with self._lock:
+            if self._jobs.get(job.key) is job:
+                del self._jobs[job.key]
+
+
+_JOB_QUEUE = None
+_JOB_QUEUE_LOCK = threading.Lock()
+
+
+def get_job_queue():
+    """Return the process-wide JobQueue, creating it on first use."""
+    global _JOB_QUEUE
+    with _JOB_QUEUE_LOCK:
+        if _JOB_QUEUE is None:
+            _JOB_QUEUE = JobQueue()
+        return _JOB_QUEUE
@@ -1,24 +1,28 @@
 import streamlit as st
 import numpy as np
 import pandas as pd
-from PIL import Image, ImageDraw
+from PIL import Image
 from lego_colors import LEGO_COLORS_ALL
 from lego_colors_round import LEGO_COLORS_ROUND
 from lego_colors_square import LEGO_COLORS_SQUARE
 from lego_colors_square_available import LEGO_COLORS_SQUARE_AVAILABLE
 from lego_colors_round_available import LEGO_COLORS_ROUND_AVAILABLE
+from baseplates import BASEPLATE_SIZES, plan_baseplates
 from utils import *
+from instruction_pages import instruction_bundle
+from encoding import IMAGE_FORMATS, IMAGE_MIME_TYPES, webp_available
+from vector_instructions import VECTOR_FORMATS, VECTOR_MIME_TYPES, vector_instructions
+from jobs import JobCancelled, get_job_queue
+from demo import load_demo_image, load_demo_mosaics, PREVIEW_PIXEL_SIZE, INSTRUCTIONS_PIXEL_SIZE
 
 selected_lego_colors = st.session_state.get('selected_lego_colors', LEGO_COLORS_ALL)
 
-# Standard baseplate sizes
-BASEPLATE_SIZES = [
-    {"name": "32×32 (standard)", "size": 32, "elementId": 6061048},
-    {"name": "48×48 (standard)", "size": 48, "elementId": 11024},
-    {"name": "64×64", "size": 64, "elementId": 6061048},
-    {"name": "96×96", "size": 96, "elementId": 11024},
-    {"name": "128×128", "size": 128, "elementId": 6061048},
-]
+@st.cache_resource(show_spinner="Preparing demo mosaics...")
+def get_demo_mosaics():
+    """Load the demo image and precompute its mosaics for all baseplate sizes, once per process."""
+    demo_img, demo_loaded = load_demo_image()
+    sizes = [s["size"] for s in BASEPLATE_SIZES]
+    return demo_img, demo_loaded, load_demo_mosaics(demo_img, sizes, LEGO_COLORS_SQUARE_AVAILABLE)
 
 def main():
     st.set_page_config(
@@ -78,6 +82,8 @@ def main():
             st.session_state.image_processed = False
             st.session_state.mosaic_created = False
             st.session_state.demo_mode = False
+            # Stop generating a mosaic nobody is waiting for anymore
+            get_job_queue().release(st.session_state.pop("mosaic_job", None))
             if 'mosaic_data' in st.session_state:
                 del st.session_state.mosaic_data
             if 'color_counts' in st.session_state:
@@ -91,6 +97,12 @@ def main():
         # File uploader - only show when not in demo mode
         if not st.session_state.demo_mode:
             uploaded_file = st.file_uploader("Upload an image (square format works best)", type=["jpg", "jpeg", "png"])
+
+            # A running job belongs to the upload it was started for; drop it when that changes
+            upload_id = uploaded_file.file_id if uploaded_file is not None else None
+            if st.session_state.get("mosaic_job_upload") != upload_id:
+                get_job_queue().release(st.session_state.pop("mosaic_job", None))
+                st.session_state.mosaic_job_upload = upload_id
             
             # Demo mode button
             if st.button("Or Use Demo Image Instead"):
@@ -101,6 +113,7 @@ def main():
             if st.button("Exit Demo Mode"):
                 st.session_state.demo_mode = False
                 st.session_state.mosaic_created = False
+                get_job_queue().release(st.session_state.pop("mosaic_job", None))
                 if 'mosaic_data' in st.session_state:
                     del st.session_state.mosaic_data
                 if 'color_counts' in st.session_state:
@@ -130,53 +143,149 @@ def main():
                 selected_lego_colors = LEGO_COLORS_SQUARE_AVAILABLE
                 st.session_state.selected_lego_colors = selected_lego_colors
                 
-                # Select mosaic size
+                # Select mosaic size; the last option allows any width × height
                 size_options = [s["name"] + f" ({s['size']}×{s['size']} studs)" for s in BASEPLATE_SIZES]
+                size_options.append("Custom width × height")
                 size_index = st.selectbox(
                     "Select Mosaic Size:",
-                    range(len(BASEPLATE_SIZES)),
+                    range(len(size_options)),
                     format_func=lambda i: size_options[i],
                     key="user_size_selector"
                 )
-                mosaic_size = BASEPLATE_SIZES[size_index]["size"]
-                st.session_state["baseplate_size"] = mosaic_size
+                if size_index < len(BASEPLATE_SIZES):
+                    mosaic_size = BASEPLATE_SIZES[size_index]["size"]
+                else:
+                    width_col, height_col = st.columns(2)
+                    with width_col:
+                        custom_width = st.number_input("Width (studs)", min_value=16, max_value=384,
+                                                       value=64, step=16, key="user_custom_width")
+                    with height_col:
+                        custom_height = st.number_input("Height (studs)", min_value=16, max_value=384,
+                                                        value=48, step=16, key="user_custom_height")
+                    mosaic_size = (int(custom_width), int(custom_height))
+                    custom_layout = plan_baseplates(*mosaic_size)
+                    if custom_layout.element_id is None:
+                        st.caption(f"This size is built on {custom_layout.count} {custom_layout.name} baseplates, "
+                                   "which are not in the Pick a Brick CSV. Multiples of 32 or 48 studs use "
+                                   "orderable baseplates.")
+
+                # Select how colors are compared when picking the closest LEGO color
+                metric_options = {
+                    "rgb": "Standard (RGB)",
+                    "lab": "Perceptual (CIELAB)",
+                    "ciede2000": "Perceptual, most accurate (CIEDE2000)",
+                }
+                color_metric = st.selectbox(
+                    "Color Matching:",
+                    list(metric_options),
+                    format_func=lambda m: metric_options[m],
+                    key="user_metric_selector"
+                )
+
+                # Dithering mixes neighbouring colors to smooth gradients
+                dither_options = {
+                    None: "None",
+                    "floyd-steinberg": "Floyd–Steinberg (smooth gradients)",
+                    "ordered": "Ordered (regular pattern)",
+                }
+                dither_mode = st.selectbox(
+                    "Dithering:",
+                    list(dither_options),
+                    format_func=lambda m: dither_options[m],
+                    key="user_dither_selector"
+                )
+
+                # Fewer colors means fewer different bricks on the shopping list
+                max_colors = st.slider(
+                    "Maximum Number of Colors:",
+                    min_value=2,
+                    max_value=len(selected_lego_colors),
+                    value=len(selected_lego_colors),
+                    key="user_max_colors_slider"
+                )
+
+                # Optionally build from bricks the user already owns
+                stock = None
+                stock_file = st.file_uploader(
+                    "Bricks you own (optional CSV with elementId and quantity columns, like the shopping list):",
+                    type=["csv"],
+                    key="user_stock_uploader"
+                )
+                strict_stock = st.checkbox(
+                    "Only use colors listed in my bricks file",
+                    value=False,
+                    key="user_strict_stock"
+                )
+                if stock_file is not None:
+                    try:
+                        stock_df = pd.read_csv(stock_file)
+                        stock = dict(zip(stock_df["elementId"].astype(int), stock_df["quantity"].astype(int)))
+                    except Exception as e:
+                        st.error(f"Error reading bricks file: {str(e)}")
                 
-                # Generate button
+                # Generate button; the mosaic is generated on the shared job queue, so a
+                # rerun reattaches to the running job instead of starting over
                 if st.button("Generate LEGO Mosaic", key="user_generate_button"):
-                    with st.spinner("Creating mosaic..."):
-                        try:
-                            mosaic_data, color_counts = create_mosaic(image, mosaic_size, selected_lego_colors)
-                            if mosaic_data:
-                                st.session_state.mosaic_data = mosaic_data
-                                st.session_state.color_counts = color_counts
-                                st.session_state.mosaic_created = True
-                                st.success("Mosaic created successfully!")
-                        except Exception as e:
-                            st.error(f"Error creating mosaic: {str(e)}")
+                    try:
+                        previous_job = st.session_state.get("mosaic_job")
+                        st.session_state.mosaic_job = submit_mosaic_job(
+                            image, mosaic_size, selected_lego_colors, metric=color_metric, dither=dither_mode,
+                            max_colors=max_colors if max_colors < len(selected_lego_colors) else None,
+                            stock=stock, strict_stock=strict_stock
+                        )
+                        get_job_queue().release(previous_job)
+                    except Exception as e:
+                        st.error(f"Error creating mosaic: {str(e)}")
+
+                job = st.session_state.get("mosaic_job")
+                # Clicking Cancel reruns the script, which interrupts the wait below
+                cancel_slot = st.empty()
+                if job is not None and cancel_slot.button("Cancel", key="user_cancel_button"):
+                    cancel_slot.empty()
+                    get_job_queue().release(job)
+                    st.session_state.mosaic_job = job = None
+                    st.info("Mosaic generation cancelled.")
+                if job is not None:
+                    progress_bar = st.progress(job.progress, text=job.stage)
+                    while not job.wait(0.1):
+                        progress_bar.progress(job.progress, text=job.stage)
+                    progress_bar.empty()
+                    cancel_slot.empty()
+                    st.session_state.mosaic_job = None
+                    try:
+                        mosaic_data, color_counts = job.result()
+                        if mosaic_data:
+                            st.session_state.mosaic_data = mosaic_data
+                            st.session_state.color_counts = color_counts
+                            st.session_state.mosaic_created = True
+                            st.success("Mosaic created successfully!")
+                            if "solve_time" in mosaic_data.stats:
+                                stats = mosaic_data.stats
+                                st.info(
+                                    f"Matched to your bricks in {stats['solve_time'] * 1000:.0f} ms: "
+                                    f"total color error {stats['total_error']:,.0f} "
+                                    f"(unlimited bricks: {stats['unconstrained_error']:,.0f}), "
+                                    f"{stats['moved_studs']} studs changed color."
+                                )
+                    except JobCancelled:
+                        pass
+                    except Exception as e:
+                        st.error(f"Error creating mosaic: {str(e)}")
         except Exception as e:
             st.error(f"Error loading image: {str(e)}")
     
     # Demo mode section
     elif st.session_state.demo_mode and not st.session_state.image_processed:
         try:
-            # Try to load the demo image file
-            demo_path = "demo_image.jpeg"
-            try:
-                demo_img = Image.open(demo_path)
+            selected_lego_colors = LEGO_COLORS_SQUARE_AVAILABLE
+            st.session_state.selected_lego_colors = selected_lego_colors
+
+            # The demo image and its mosaics for every size are prepared once per process
+            demo_img, demo_loaded, demo_mosaics = get_demo_mosaics()
+            if demo_loaded:
                 st.success(f"Successfully loaded demo image")
-            except (FileNotFoundError, IOError):
-                # If file not found or can't be opened, create a simple gradient image
+            else:
                 st.warning(f"Demo image file not found. Creating a simple gradient image instead.")
-                demo_img = Image.new('RGB', (300, 300), color='white')
-                draw = ImageDraw.Draw(demo_img)
-                
-                # Draw a simple pattern
-                for y in range(300):
-                    for x in range(300):
-                        r = int(255 * x / 300)
-                        g = int(255 * y / 300)
-                        b = int(255 * (1 - (x + y) / 600))
-                        draw.point((x, y), fill=(r, g, b))
             
             st.session_state.current_image = demo_img
                 
@@ -188,9 +297,6 @@ def main():
             # Mosaic settings for demo
             with col1:
                 st.write("### Demo Mosaic Settings")
-                
-                selected_lego_colors = LEGO_COLORS_SQUARE_AVAILABLE
-                st.session_state.selected_lego_colors = selected_lego_colors
                                 
                 # Select mosaic size
                 size_options = [s["name"] + f" ({s['size']}×{s['size']} studs)" for s in BASEPLATE_SIZES]
@@ -201,23 +307,25 @@ def main():
                     key="demo_size_selector"
                 )
                 mosaic_size = BASEPLATE_SIZES[size_index]["size"]
-                st.session_state["baseplate_size"] = mosaic_size
                 
                 # Generate button for demo
                 if st.button("Generate Demo LEGO Mosaic", key="demo_generate_button"):
-                    with st.spinner("Creating demo mosaic...(that might take some seconds)"):
-                        try:
-                            # Create the mosaic
-                            mosaic_data, color_counts = create_mosaic(demo_img, mosaic_size, selected_lego_colors)
-                            if mosaic_data:
-                                st.session_state.mosaic_data = mosaic_data
-                                st.session_state.color_counts = color_counts
-                                st.session_state.mosaic_created = True
-                                st.session_state.image_processed = True
-                                st.success("Demo mosaic created successfully!")
-                                st.rerun()  # Force UI update
-                        except Exception as e:
-                            st.error(f"Error creating demo mosaic: {str(e)}")
+                    try:
+                        demo = demo_mosaics.get(mosaic_size)
+                        if demo is None:
+                            with st.spinner("Creating demo mosaic..."):
+                                mosaic_data, color_counts = create_mosaic(demo_img, mosaic_size, selected_lego_colors)
+                        else:
+                            mosaic_data, color_counts = demo.mosaic, dict(demo.color_counts)
+                        if mosaic_data:
+                            st.session_state.mosaic_data = mosaic_data
+                            st.session_state.color_counts = color_counts
+                            st.session_state.mosaic_created = True
+                            st.session_state.image_processed = True
+                            st.success("Demo mosaic created successfully!")
+                            st.rerun()  # Force UI update
+                    except Exception as e:
+                        st.error(f"Error creating demo mosaic: {str(e)}")
         except Exception as e:
             st.error(f"Error with demo image: {str(e)}")
     
@@ -237,15 +345,24 @@ def main():
         st.write("### ")
         st.write("### Results")
         try:
+            # Image format for the mosaic and instruction downloads
+            download_formats = [f for f in IMAGE_FORMATS if f != "webp" or webp_available()]
+            download_format = st.radio("Download format:", download_formats,
+                                       format_func=lambda f: {"png": "PNG", "webp": "WebP (smaller)"}[f],
+                                       horizontal=True, key="download_format_selector")
+
             # Create tabs for different views
             tab1, tab2, tab3 = st.tabs(["Mosaic Preview", "Building Instructions", "Shopping List"])
             
             # Tab 1: Mosaic Preview
             with tab1:
                 st.write("#### Mosaic Preview")
-                pixel_size = st.slider("Zoom Level:", min_value=5, max_value=20, value=10)
+                zoom = st.slider("Zoom Level:", min_value=5, max_value=20, value=PREVIEW_PIXEL_SIZE)
+                pixel_size = fit_pixel_size(mosaic_data, zoom)
+                if pixel_size < zoom:
+                    st.caption(f"Large mosaics are shown at {pixel_size} pixels per stud.")
 
-                mosaic_img = draw_mosaic(mosaic_data, pixel_size)
+                mosaic_img = render_image_cached("mosaic", mosaic_data, pixel_size)
                 
                 if mosaic_img:
                     st.image(mosaic_img)
@@ -253,9 +370,9 @@ def main():
                     # Add mosaic download tracking
                     if st.download_button(
                         label="Download Mosaic Image",
-                        data=instructions_img_to_bytes(mosaic_img),
-                        file_name="lego_mosaic.png",
-                        mime="image/png",
+                        data=lazy_render_download("mosaic", mosaic_data, pixel_size, fmt=download_format),
+                        file_name=f"lego_mosaic.{download_format}",
+                        mime=IMAGE_MIME_TYPES[download_format],
                     ):
                         try:
                             save_mosaic_download_to_google_sheets()
@@ -270,7 +387,14 @@ def main():
 
                 # Draw instructions with color legend
                 lego_colors_used = st.session_state.get("selected_lego_colors", LEGO_COLORS_ALL)
-                instructions_img = draw_instructions(mosaic_data, color_counts=color_counts, lego_colors_used=lego_colors_used)
+                # Large mosaics are drawn with smaller cells; the vector and per-page downloads keep full size
+                instructions_pixel_size = fit_pixel_size(mosaic_data, INSTRUCTIONS_PIXEL_SIZE)
+                if instructions_pixel_size < INSTRUCTIONS_PIXEL_SIZE:
+                    st.caption(f"This large mosaic is shown at {instructions_pixel_size} pixels per stud. "
+                               "Download the vector instructions or the instruction pages for full size.")
+                instructions_img = render_image_cached(
+                    "instructions", mosaic_data, instructions_pixel_size, color_counts=color_counts, lego_colors_used=lego_colors_used
+                )
                 
                 if instructions_img:
                     st.image(instructions_img)
@@ -278,46 +402,60 @@ def main():
                     # Track the instruction download event
                     if st.download_button(
                         label="Download Instructions with Color Legend",
-                        data=instructions_img_to_bytes(instructions_img),
-                        file_name="lego_instructions.png",
-                        mime="image/png",
+                        data=lazy_render_download("instructions", mosaic_data, instructions_pixel_size,
+                                                  color_counts=color_counts, lego_colors_used=lego_colors_used,
+                                                  fmt=download_format),
+                        file_name=f"lego_instructions.{download_format}",
+                        mime=IMAGE_MIME_TYPES[download_format],
+                    ):
+                        try:
+                            save_instruction_download_to_google_sheets()
+                        except Exception as e:
+                            st.warning(f"Error logging instruction download: {str(e)}")
+
+                    # Vector instructions stay sharp at any print size
+                    vector_format = st.radio("Vector instructions format:", list(VECTOR_FORMATS),
+                                             format_func=str.upper, horizontal=True,
+                                             key="vector_format_selector")
+                    if st.download_button(
+                        label=f"Download Instructions as {vector_format.upper()}",
+                        data=deferred_download(lambda: vector_instructions(
+                            mosaic_data, vector_format, INSTRUCTIONS_PIXEL_SIZE,
+                            color_counts=color_counts, lego_colors_used=lego_colors_used)),
+                        file_name=f"lego_instructions.{vector_format}",
+                        mime=VECTOR_MIME_TYPES[vector_format],
                     ):
                         try:
                             save_instruction_download_to_google_sheets()
                         except Exception as e:
                             st.warning(f"Error logging instruction download: {str(e)}")
 
+                    # Large mosaics are easier to build from one page per baseplate
+                    layout = plan_baseplates(mosaic_data.width, mosaic_data.height)
+                    if layout.count > 1:
+                        page_format = st.radio("Instruction pages format:", ["zip", "pdf"],
+                                               format_func=lambda f: {"zip": "ZIP of PNG pages", "pdf": "PDF"}[f],
+                                               horizontal=True, key="page_format_selector")
+                        # The pages are only rendered once the button is clicked
+                        if st.download_button(
+                            label=f"Download {layout.count} Instruction Pages ({layout.name} per page)",
+                            data=deferred_download(lambda: instruction_bundle(
+                                mosaic_data, INSTRUCTIONS_PIXEL_SIZE, page_format, color_counts=color_counts)),
+                            file_name=f"lego_instructions_pages.{page_format}",
+                            mime="application/zip" if page_format == "zip" else "application/pdf",
+                        ):
+                            try:
+                                save_instruction_download_to_google_sheets()
+                            except Exception as e:
+                                st.warning(f"Error logging instruction download: {str(e)}")
+
             # Tab 3: Shopping List
             with tab3:
                 st.write("#### Shopping List")
                 st.write("Here are the LEGO 1×1 plates you need to buy:")
                 lego_colors_used = st.session_state.get("selected_lego_colors", LEGO_COLORS_ALL)
 
-                # Create shopping list dataframe
-                shopping_data = []
-                for color_name, count in color_counts.items():
-                    color_info = next((c for c in lego_colors_used if c[0] == color_name), None)
-                    if color_info:
-                        shopping_data.append({
-                            "Color Name": color_name,
-                            "quantity": count,
-                            "Color Preview": color_info[1],
-                            "elementId": color_info[-1]
-                        })
-
-                # Add baseplate depending on chosen size
-                chosen_size = st.session_state.get("baseplate_size")  # or however you store the chosen size
-                quantity_map = {32: 1, 48: 1, 64: 4, 96: 4, 128: 16}
-                baseplate_info = next((b for b in BASEPLATE_SIZES if b["size"] == chosen_size), None)
-                if baseplate_info:
-                    shopping_data.insert(0, {  # insert at top of list
-                        "Color Name": f"Baseplate {baseplate_info['name']}",
-                        "quantity": quantity_map.get(chosen_size, 1),
-                        "Color Preview": "#DDDDDD",  # neutral gray placeholder
-                        "elementId": baseplate_info["elementId"]
-                    })
-
-                shopping_df = pd.DataFrame(shopping_data).sort_values(by="quantity", ascending=False)
+                shopping_df = shopping_list(color_counts, lego_colors_used, mosaic_data.size)
 
                 # Display shopping list
                 for i, row in shopping_df.iterrows():
@@ -332,6 +470,12 @@ def main():
 
                 st.write(f"**Total Pieces:** {sum(color_counts.values())}")
 
+                # Pick a Brick only takes elementIds, e.g. 16×16 baseplates have none on record
+                not_orderable = shopping_df.loc[shopping_df["elementId"].isna(), "Color Name"].tolist()
+                if not_orderable:
+                    st.info("Not included in the CSV because they have no Pick a Brick elementId: "
+                            + ", ".join(not_orderable) + ". Order these separately.")
+
                 st.markdown(
                 "Download the shopping list by clicking the button below.<br><br>"
                 "You can upload the shoppinglist directly to Lego Pick A Brick to automate the purchasing process.<br><br>"
@@ -339,10 +483,9 @@ def main():
                 unsafe_allow_html=True
 )
                 # Export and track CSV download
-                csv = shopping_df[["elementId", "quantity"]].to_csv(index=False)
                 if st.download_button(
                     label="Download Shopping List (CSV)",
-                    data=csv,
+                    data=deferred_download(lambda: shopping_list_csv(shopping_df)),
                     file_name="lego_shopping_list.csv",
                     mime="text/csv",
                 ):
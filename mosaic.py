@@ -0,0 +1,88 @@
+import hashlib
+
+import numpy as np
+
+from palette import Palette
+
+
+class Mosaic:
+    """A LEGO mosaic stored as a compact grid of palette indices.
+
+    Attributes:
+        indices: Read-only uint8/uint16 (height, width) array of palette indices.
+        palette: The Palette the indices refer to.
+        stats: Dict of generation statistics (e.g. from the inventory solver).
+    """
+
+    def __init__(self, indices, palette, stats=None):
+        indices = np.array(indices, dtype=palette.index_dtype, copy=True)
+        indices.setflags(write=False)
+        self.indices = indices
+        self.palette = palette
+        self.stats = stats or {}
+        self._digest = None
+
+    @classmethod
+    def from_rows(cls, mosaic_rows):
+        """Build a Mosaic from the legacy nested-list form (rows of palette entries)."""
+        entries = []
+        positions = {}
+        indices = []
+        for row in mosaic_rows:
+            index_row = []
+            for color in row:
+                position = positions.get(id(color))
+                if position is None:
+                    position = positions[id(color)] = len(entries)
+                    entries.append(color)
+                index_row.append(position)
+            indices.append(index_row)
+        palette = Palette(entries)
+        return cls(np.array(indices, dtype=np.int64).reshape(len(indices), -1), palette)
+
+    def __len__(self):
+        # Number of rows, so existing `len(mosaic_data)` and truthiness checks keep working
+        return self.indices.shape[0]
+
+    @property
+    def height(self):
+        return self.indices.shape[0]
+
+    @property
+    def width(self):
+        return self.indices.shape[1]
+
+    @property
+    def size(self):
+        """(width, height) in studs."""
+        return self.width, self.height
+
+    @property
+    def nbytes(self):
+        return self.indices.nbytes
+
+    @property
+    def digest(self):
+        """Hex digest of the grid contents and palette, used as a cache key."""
+        if self._digest is None:
+            hasher = hashlib.blake2b(digest_size=16)
+            hasher.update(repr((self.indices.shape, self.palette.key)).encode())
+            hasher.update(self.indices.tobytes())
+            self._digest = hasher.hexdigest()
+        return self._digest
+
+    def color_counts(self):
+        """Count studs per color name, ordered by first appearance (row-major)."""
+        return self.palette.count_colors(self.indices)
+
+    def to_rows(self):
+        """Expand into the legacy nested-list form (rows of palette entries)."""
+        colors = self.palette.colors
+        return [[colors[i] for i in row] for row in self.indices.tolist()]
+
+
+def as_mosaic(mosaic_data):
+    """Return ``mosaic_data`` as a Mosaic, converting the legacy nested-list form if needed."""
+    if mosaic_data is None or isinstance(mosaic_data, Mosaic):
+        return mosaic_data
+    return Mosaic.from_rows(mosaic_data)
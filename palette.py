@@ -0,0 +1,156 @@
+import hashlib
+
+import numpy as np
+
+
+# Number of pixels matched per batch; bounds the (pixels x colors x 3) distance buffer.
+_MATCH_CHUNK_SIZE = 16384
+
+# Palettes are module-level constants, so each one is compiled once per process.
+_PALETTE_CACHE = {}
+
+
+def parse_hex_color(hex_color):
+    """Convert a hex color string ("#RRGGBB" or "RRGGBB") into an (r, g, b) tuple."""
+    hex_color = str(hex_color).lstrip("#")
+    return int(hex_color[0:2], 16), int(hex_color[2:4], 16), int(hex_color[4:6], 16)
+
+
+def rgb_to_lab(rgb):
+    """Convert sRGB values (..., 3) in 0-255 to CIELAB (D65 white point)."""
+    rgb = np.asarray(rgb, dtype=np.float64) / 255.0
+    linear = np.where(rgb > 0.04045, ((rgb + 0.055) / 1.055) ** 2.4, rgb / 12.92)
+
+    matrix = np.array([
+        [0.4124564, 0.3575761, 0.1804375],
+        [0.2126729, 0.7151522, 0.0721750],
+        [0.0193339, 0.1191920, 0.9503041],
+    ])
+    xyz = linear @ matrix.T / np.array([0.95047, 1.0, 1.08883])
+
+    f = np.where(xyz > 216 / 24389, np.cbrt(xyz), (24389 / 27 * xyz + 16) / 116)
+    lightness = 116 * f[..., 1] - 16
+    a = 500 * (f[..., 0] - f[..., 1])
+    b = 200 * (f[..., 1] - f[..., 2])
+    return np.stack([lightness, a, b], axis=-1)
+
+
+class Palette:
+    """A LEGO color palette compiled once into lookup structures shared by all call sites.
+
+    Attributes:
+        colors: The original palette list ([name, hex, r, g, b, (elementId)] entries).
+        names: Color names in palette order.
+        hex_colors: Hex strings normalized to "#RRGGBB".
+        rgb: uint8 (N, 3) array of display colors parsed from the hex strings.
+        text_rgb: Black or white text color per entry, chosen by brightness.
+        element_ids: LEGO elementIds, or None for palettes without that column.
+        lab: float (N, 3) array of CIELAB coordinates of the matching colors.
+        name_to_index: Maps a color name to its palette index.
+        element_to_index: Maps an elementId to its palette index.
+        key: Hex digest of the palette contents.
+    """
+
+    def __init__(self, lego_colors):
+        self.colors = lego_colors
+        self.names = []
+        self.hex_colors = []
+        self.element_ids = []
+        self.name_to_index = {}
+        self.element_to_index = {}
+
+        display_rgb = []
+        match_rgb = []
+        valid = []
+        for i, color in enumerate(lego_colors):
+            name = color[0] if len(color) > 0 else ""
+            element_id = color[5] if len(color) > 5 else None
+            self.names.append(name)
+            self.element_ids.append(element_id)
+            self.name_to_index.setdefault(name, i)
+            if element_id is not None:
+                self.element_to_index.setdefault(element_id, i)
+
+            try:
+                cr, cg, cb = float(color[2]), float(color[3]), float(color[4])
+            except (ValueError, TypeError, IndexError):
+                # Malformed entries are kept for indexing but never matched
+                cr, cg, cb = 0.0, 0.0, 0.0
+            else:
+                valid.append(i)
+            match_rgb.append((cr, cg, cb))
+
+            try:
+                display_rgb.append(parse_hex_color(color[1]))
+            except (ValueError, TypeError, IndexError):
+                display_rgb.append((int(cr), int(cg), int(cb)))
+            self.hex_colors.append("#%02X%02X%02X" % display_rgb[-1])
+
+        self.rgb = np.array(display_rgb, dtype=np.uint8).reshape(-1, 3)
+        # Black or white, whichever reads better on top of each color
+        self.text_rgb = [
+            (0, 0, 0) if (r * 299 + g * 587 + b * 114) / 1000 > 128 else (255, 255, 255)
+            for r, g, b in display_rgb
+        ]
+        self._match_rgb = np.array(match_rgb, dtype=np.float32).reshape(-1, 3)
+        self._valid = np.array(valid, dtype=np.intp)
+        self.lab = rgb_to_lab(self._match_rgb)
+        self.index_dtype = np.uint8 if len(lego_colors) <= 256 else np.uint16
+        # Content digest, so equal palettes share cache entries across lists and processes
+        self.key = hashlib.blake2b(repr([list(color) for color in lego_colors]).encode(),
+                                   digest_size=16).hexdigest()
+
+    def __len__(self):
+        return len(self.colors)
+
+    def lookup(self, name):
+        """Return the palette entry for a color name, or None if it is not in the palette."""
+        index = self.name_to_index.get(name)
+        return None if index is None else self.colors[index]
+
+    def match(self, pixel_data):
+        """Assign every pixel to its closest palette color in one batched pass.
+
+        Args:
+            pixel_data: Array of shape (..., 3) holding RGB values.
+
+        Returns:
+            Integer array with the shape of ``pixel_data`` minus its last axis, holding
+            the index of the closest palette entry for each pixel.
+        """
+        pixel_data = np.asarray(pixel_data)
+        grid_shape = pixel_data.shape[:-1]
+        if len(self._valid) == 0:
+            return np.zeros(grid_shape, dtype=self.index_dtype)
+
+        colors = self._match_rgb[self._valid]
+        pixels = pixel_data.reshape(-1, 3).astype(np.float32)
+        nearest = np.empty(len(pixels), dtype=np.intp)
+        for start in range(0, len(pixels), _MATCH_CHUNK_SIZE):
+            chunk = pixels[start:start + _MATCH_CHUNK_SIZE]
+            # Squared distances are exact for 8-bit values in float32, so ties resolve
+            # to the first palette entry exactly like the scalar search did.
+            distances = ((chunk[:, None, :] - colors[None, :, :]) ** 2).sum(axis=2)
+            nearest[start:start + len(chunk)] = distances.argmin(axis=1)
+
+        return self._valid[nearest].astype(self.index_dtype).reshape(grid_shape)
+
+    def count_colors(self, indices):
+        """Count palette usage in an index grid, ordered by first appearance (row-major)."""
+        flat = np.asarray(indices).ravel()
+        counts = np.bincount(flat, minlength=len(self.colors))
+        # The first-appearance order decides the color numbers on the instructions
+        used, first_seen = np.unique(flat, return_index=True)
+        return {self.names[i]: int(counts[i]) for i in used[np.argsort(first_seen)]}
+
+
+def get_palette(lego_colors):
+    """Return the compiled Palette for a palette list, building it on first use."""
+    cached = _PALETTE_CACHE.get(id(lego_colors))
+    # Keep a reference to the list so its id cannot be reused by another palette
+    if cached is not None and cached[0] is lego_colors:
+        return cached[1]
+
+    palette = Palette(lego_colors)
+    _PALETTE_CACHE[id(lego_colors)] = (lego_colors, palette)
+    return palette
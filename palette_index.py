@@ -0,0 +1,141 @@
+import threading
+
+import numpy as np
+from sklearn.neighbors import NearestNeighbors
+
+from palette import rgb_to_lab
+
+
+# Supported color distance metrics: plain RGB Euclidean, CIE76 (Euclidean in CIELAB)
+# and CIEDE2000
+METRICS = ("rgb", "lab", "ciede2000")
+
+# Built indexes keyed by (palette key, metric, candidates), shared by all sessions
+_INDEX_CACHE = {}
+_INDEX_LOCK = threading.Lock()
+
+
+def ciede2000(lab1, lab2):
+    """CIEDE2000 color difference between broadcastable (..., 3) CIELAB arrays."""
+    L1, a1, b1 = lab1[..., 0], lab1[..., 1], lab1[..., 2]
+    L2, a2, b2 = lab2[..., 0], lab2[..., 1], lab2[..., 2]
+
+    C1 = np.hypot(a1, b1)
+    C2 = np.hypot(a2, b2)
+    C_mean7 = ((C1 + C2) / 2) ** 7
+    G = 0.5 * (1 - np.sqrt(C_mean7 / (C_mean7 + 25.0 ** 7)))
+    a1p = (1 + G) * a1
+    a2p = (1 + G) * a2
+    C1p = np.hypot(a1p, b1)
+    C2p = np.hypot(a2p, b2)
+    h1p = np.degrees(np.arctan2(b1, a1p)) % 360
+    h2p = np.degrees(np.arctan2(b2, a2p)) % 360
+
+    dLp = L2 - L1
+    dCp = C2p - C1p
+    dhp = h2p - h1p
+    dhp = np.where(dhp > 180, dhp - 360, np.where(dhp < -180, dhp + 360, dhp))
+    dhp = np.where(C1p * C2p == 0, 0, dhp)
+    dHp = 2 * np.sqrt(C1p * C2p) * np.sin(np.radians(dhp / 2))
+
+    Lp_mean = (L1 + L2) / 2
+    Cp_mean = (C1p + C2p) / 2
+    hp_sum = h1p + h2p
+    hp_mean = np.where(
+        C1p * C2p == 0, hp_sum,
+        np.where(np.abs(h1p - h2p) <= 180, hp_sum / 2,
+                 np.where(hp_sum < 360, (hp_sum + 360) / 2, (hp_sum - 360) / 2)))
+
+    T = (1 - 0.17 * np.cos(np.radians(hp_mean - 30))
+         + 0.24 * np.cos(np.radians(2 * hp_mean))
+         + 0.32 * np.cos(np.radians(3 * hp_mean + 6))
+         - 0.20 * np.cos(np.radians(4 * hp_mean - 63)))
+    d_theta = 30 * np.exp(-(((hp_mean - 275) / 25) ** 2))
+    Cp_mean7 = Cp_mean ** 7
+    R_C = 2 * np.sqrt(Cp_mean7 / (Cp_mean7 + 25.0 ** 7))
+    S_L = 1 + 0.015 * (Lp_mean - 50) ** 2 / np.sqrt(20 + (Lp_mean - 50) ** 2)
+    S_C = 1 + 0.045 * Cp_mean
+    S_H = 1 + 0.015 * Cp_mean * T
+    R_T = -np.sin(np.radians(2 * d_theta)) * R_C
+
+    return np.sqrt((dLp / S_L) ** 2 + (dCp / S_C) ** 2 + (dHp / S_H) ** 2
+                   + R_T * (dCp / S_C) * (dHp / S_H))
+
+
+class PaletteIndex:
+    """Nearest-color search over a palette in a perceptual color space.
+
+    Palette coordinates are precomputed once and indexed with a KD-tree. Queries are batched
+    over the whole image and only distinct pixel colors are converted and searched.
+    CIEDE2000 is not a metric a tree can index directly, so the tree proposes the
+    ``candidates`` nearest colors in CIELAB and those are re-ranked by CIEDE2000.
+
+    Args:
+        palette: Compiled Palette.
+        metric: One of METRICS.
+        candidates: CIELAB neighbours re-ranked for CIEDE2000 (None re-ranks the whole palette).
+    """
+
+    def __init__(self, palette, metric="lab", candidates=16):
+        if metric not in METRICS:
+            raise ValueError(f"Unknown color metric: {metric}")
+        self.palette = palette
+        self.metric = metric
+        # Palettes can list the same color under several names; keep the first entry of
+        # each so ties resolve like the exhaustive RGB search
+        _, first = np.unique(palette._match_rgb[palette._valid], axis=0, return_index=True)
+        self._valid = palette._valid[np.sort(first)]
+        if metric == "rgb":
+            self._coords = palette._match_rgb[self._valid].astype(np.float64)
+        else:
+            self._coords = palette.lab[self._valid]
+
+        if metric == "ciede2000":
+            self.candidates = len(self._valid) if candidates is None else min(candidates, len(self._valid))
+        else:
+            self.candidates = 1
+        self._tree = None
+        if len(self._valid):
+            self._tree = NearestNeighbors(n_neighbors=self.candidates, algorithm="kd_tree")
+            self._tree.fit(self._coords)
+
+    def _to_coords(self, rgb):
+        return rgb.astype(np.float64) if self.metric == "rgb" else rgb_to_lab(rgb)
+
+    def match(self, pixel_data):
+        """Assign every pixel to its nearest palette index under the index's metric.
+
+        Args:
+            pixel_data: Array of shape (..., 3) holding RGB values.
+
+        Returns:
+            Integer array with the shape of ``pixel_data`` minus its last axis.
+        """
+        pixel_data = np.asarray(pixel_data)
+        grid_shape = pixel_data.shape[:-1]
+        if self._tree is None:
+            return np.zeros(grid_shape, dtype=self.palette.index_dtype)
+
+        # Photos have far fewer distinct colors than pixels once resized to stud resolution
+        unique_rgb, inverse = np.unique(pixel_data.reshape(-1, 3), axis=0, return_inverse=True)
+        coords = self._to_coords(unique_rgb)
+        _, neighbours = self._tree.kneighbors(coords)
+
+        if self.metric == "ciede2000" and self.candidates > 1:
+            distances = ciede2000(coords[:, None, :], self._coords[neighbours])
+            nearest = neighbours[np.arange(len(neighbours)), distances.argmin(axis=1)]
+        else:
+            nearest = neighbours[:, 0]
+
+        indices = self._valid[nearest].astype(self.palette.index_dtype)
+        return indices[inverse.ravel()].reshape(grid_shape)
+
+
+def get_palette_index(palette, metric="lab", candidates=16):
+    """Return the PaletteIndex for a palette and metric, building it once per process."""
+    key = (palette.key, metric, candidates)
+    with _INDEX_LOCK:
+        index = _INDEX_CACHE.get(key)
+        if index is None:
+            index = _INDEX_CACHE[key] = PaletteIndex(palette, metric, candidates)
+        return index
@@ -0,0 +1,46 @@
+import numpy as np
+from sklearn.cluster import MiniBatchKMeans
+
+
+def reduce_palette(pixel_data, palette, max_colors, match, sample_size=4096, random_state=0):
+    """Pick the best ``max_colors`` palette colors for an image.
+
+    Clusters a random subsample of the pixels with MiniBatchKMeans, snaps the cluster
+    centers to their nearest palette colors and, if several centers snap to the same color,
+    tops the selection up with the colors the sample uses most.
+
+    Args:
+        pixel_data: Array of shape (..., 3) holding RGB values.
+        palette: Compiled Palette to choose from.
+        max_colors: Maximum number of colors to keep.
+        match: Callable mapping an (N, 3) array of RGB values to indices into ``palette``.
+        sample_size: Number of pixels used for clustering.
+        random_state: Seed for the subsample and the clustering.
+
+    Returns:
+        Sorted array of the selected palette indices.
+    """
+    pixels = np.asarray(pixel_data, dtype=np.float32).reshape(-1, 3)
+    rng = np.random.default_rng(random_state)
+    if len(pixels) > sample_size:
+        pixels = pixels[rng.choice(len(pixels), sample_size, replace=False)]
+
+    # Without clustering, this is the set of colors the image would use
+    nearest = np.asarray(match(pixels)).astype(np.intp)
+    used, counts = np.unique(nearest, return_counts=True)
+    if len(used) <= max_colors:
+        return used
+
+    distinct = len(np.unique(pixels, axis=0))
+    kmeans = MiniBatchKMeans(n_clusters=min(max_colors, distinct), batch_size=1024, n_init=3,
+                             random_state=random_state)
+    kmeans.fit(pixels)
+    selected = list(dict.fromkeys(np.asarray(match(kmeans.cluster_centers_)).astype(np.intp).tolist()))
+
+    # Several centers can snap to the same LEGO color; fill up with the most used colors
+    for index in used[np.argsort(-counts, kind="stable")].tolist():
+        if len(selected) >= max_colors:
+            break
+        if index not in selected:
+            selected.append(index)
+    return np.array(sorted(selected[:max_colors]), dtype=np.intp)
@@ -0,0 +1,492 @@
+"""HTTP service exposing mosaic generation to other frontends.
+
+Every request carries the image as the raw request body and its options in the query
+string, so the service keeps no per-client state. Work runs on a bounded pool of worker
+threads; identical requests share one result, from the response cache or the job that
+is still computing it.
+
+Endpoints:
+    GET  /health          Service status as JSON.
+    POST /generate        Mosaic summary (size, baseplates, color counts) as JSON.
+    POST /render          Preview or instructions (?view=preview|dots|instructions&format=png|webp|svg|pdf).
+    POST /pages           Per-baseplate instruction pages as a ZIP, streamed page by page.
+    POST /shopping-list   Pick a Brick CSV (or ?format=json).
+
+Options shared by all POST endpoints: size (48 or 64x48), palette, metric, dither, max_colors.
+
+Example:
+    python service.py --port 8000 --workers 2
+    curl --data-binary @photo.jpg "http://localhost:8000/render?size=48&view=instructions&format=svg" -o instructions.svg
+"""
+import argparse
+import hashlib
+import io
+import itertools
+import json
+import logging
+import queue
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from PIL import Image, UnidentifiedImageError
+
+from baseplates import mosaic_dimensions, plan_baseplates
+from batch import PALETTES, parse_size
+from cache import LRUCache
+from dither import DITHER_MODES
+from encoding import IMAGE_FORMATS, IMAGE_MIME_TYPES, encode_image, webp_available
+from instruction_pages import iter_instruction_pages, page_layout, write_pages_zip
+from jobs import JobCancelled, JobQueue
+from palette_index import METRICS
+from utils import (create_mosaic, draw_instructions, draw_mosaic, draw_mosaic_with_dots, shopping_list,
+                   shopping_list_csv)
+from vector_instructions import VECTOR_FORMATS, VECTOR_MIME_TYPES, vector_instructions
+
+logger = logging.getLogger(__name__)
+
+# Request limits
+MAX_UPLOAD_BYTES = 16 * 1024 * 1024
+MAX_IMAGE_PIXELS = 40_000_000
+# Matches the largest custom size of the app; raster renders are further bounded by
+# MAX_RENDER_SIDE, so the largest murals need a smaller pixel_size or a vector format
+MAX_MOSAIC_SIDE = 384
+MAX_PIXEL_SIZE = 64
+# Largest side of a rendered image, in pixels
+MAX_RENDER_SIDE = 8192
+
+# Seconds a request waits for its result before giving up
+REQUEST_TIMEOUT = 120
+
+# Bodies are written to the socket in slices of this size
+WRITE_CHUNK_SIZE = 256 * 1024
+
+VIEWS = ("preview", "dots", "instructions")
+SHOPPING_LIST_FORMATS = ("csv", "json")
+
+
+class ServiceError(Exception):
+    """A request that cannot be answered, with the HTTP status to report."""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+def _choice_param(params, name, choices, default):
+    value = params.pop(name, default)
+    if value is not default and value not in choices:
+        raise ServiceError(400, f"{name} must be one of: {', '.join(choices)}")
+    return value
+
+
+def _int_param(params, name, default, low, high):
+    text = params.pop(name, None)
+    if text is None:
+        return default
+    try:
+        value = int(text)
+    except ValueError:
+        raise ServiceError(400, f"{name} must be an integer") from None
+    if not low <= value <= high:
+        raise ServiceError(400, f"{name} must be between {low} and {high}")
+    return value
+
+
+def _check_render_size(options, pixel_size):
+    if max(mosaic_dimensions(options["size"])) * pixel_size > MAX_RENDER_SIDE:
+        raise ServiceError(413, f"Rendered images are limited to {MAX_RENDER_SIDE} pixels per side; "
+                                "use a smaller pixel_size")
+
+
+def _parse_mosaic_options(params):
+    try:
+        size = parse_size(params.pop("size", "48"))
+    except ValueError:
+        raise ServiceError(400, "size must look like 48 or 64x48") from None
+    width, height = mosaic_dimensions(size)
+    if not (1 <= width <= MAX_MOSAIC_SIDE and 1 <= height <= MAX_MOSAIC_SIDE):
+        raise ServiceError(413, f"Mosaics are limited to {MAX_MOSAIC_SIDE} studs per side")
+    return {
+        "size": size,
+        "palette": _choice_param(params, "palette", tuple(PALETTES), "square-available"),
+        "metric": _choice_param(params, "metric", METRICS, "rgb"),
+        "dither": _choice_param(params, "dither", DITHER_MODES, None),
+        "max_colors": _int_param(params, "max_colors", None, 1, 256),
+    }
+
+
+def _parse_generate(params):
+    options = _parse_mosaic_options(params)
+    options["grid"] = bool(_int_param(params, "grid", 0, 0, 1))
+    return options
+
+
+def _parse_render(params):
+    options = _parse_mosaic_options(params)
+    options["view"] = _choice_param(params, "view", VIEWS, "preview")
+    formats = IMAGE_FORMATS + VECTOR_FORMATS if options["view"] == "instructions" else IMAGE_FORMATS
+    options["format"] = _choice_param(params, "format", formats, "png")
+    if options["format"] == "webp" and not webp_available():
+        raise ServiceError(400, "WebP output is not available on this server")
+    default_pixel_size = 24 if options["view"] == "instructions" else 10
+    options["pixel_size"] = _int_param(params, "pixel_size", default_pixel_size, 1, MAX_PIXEL_SIZE)
+    if options["format"] not in VECTOR_FORMATS:
+        _check_render_size(options, options["pixel_size"])
+    return options
+
+
+def _parse_pages(params):
+    options = _parse_mosaic_options(params)
+    options["pixel_size"] = _int_param(params, "pixel_size", 24, 1, MAX_PIXEL_SIZE)
+    options["plate_size"] = _int_param(params, "plate_size", None, 1, MAX_MOSAIC_SIDE)
+    _check_render_size(dict(options, size=options["plate_size"] or options["size"]), options["pixel_size"])
+    return options
+
+
+def _parse_shopping_list(params):
+    options = _parse_mosaic_options(params)
+    options["format"] = _choice_param(params, "format", SHOPPING_LIST_FORMATS, "csv")
+    return options
+
+
+def _generate_response(mosaic_data, color_counts, options):
+    layout = plan_baseplates(mosaic_data.width, mosaic_data.height)
+    summary = {
+        "width": mosaic_data.width,
+        "height": mosaic_data.height,
+        "digest": mosaic_data.digest,
+        "baseplates": {"name": layout.name, "count": layout.count, "element_id": layout.element_id},
+        "color_counts": color_counts,
+    }
+    if options["grid"]:
+        palette = mosaic_data.palette
+        summary["colors"] = [{"name": name, "hex": hex_color}
+                             for name, hex_color in zip(palette.names, palette.hex_colors)]
+        summary["grid"] = mosaic_data.indices.tolist()
+    return "application/json", json.dumps(summary).encode("utf-8")
+
+
+def _render_response(mosaic_data, color_counts, options):
+    lego_colors = PALETTES[options["palette"]]
+    fmt, pixel_size = options["format"], options["pixel_size"]
+    if options["view"] == "instructions":
+        if fmt in VECTOR_FORMATS:
+            return VECTOR_MIME_TYPES[fmt], vector_instructions(mosaic_data, fmt, pixel_size,
+                                                               color_counts, lego_colors)
+        image = draw_instructions(mosaic_data, pixel_size, color_counts, lego_colors)
+    elif options["view"] == "dots":
+        image = draw_mosaic_with_dots(mosaic_data, pixel_size)
+    else:
+        image = draw_mosaic(mosaic_data, pixel_size)
+    return IMAGE_MIME_TYPES[fmt], encode_image(image, fmt)
+
+
+def _shopping_list_response(mosaic_data, color_counts, options):
+    shopping_df = shopping_list(color_counts, PALETTES[options["palette"]], options["size"])
+    if options["format"] == "json":
+        return "application/json", shopping_df.to_json(orient="records").encode("utf-8")
+    return "text/csv; charset=utf-8", shopping_list_csv(shopping_df).encode("utf-8")
+
+
+# Path -> (option parser, response builder); /pages is streamed and handled separately
+ENDPOINTS = {
+    "/generate": (_parse_generate, _generate_response),
+    "/render": (_parse_render, _render_response),
+    "/shopping-list": (_parse_shopping_list, _shopping_list_response),
+}
+
+
+def _load_image(body):
+    """Decode an uploaded image, refusing images with more than MAX_IMAGE_PIXELS pixels."""
+    try:
+        image = Image.open(io.BytesIO(body))
+    except Image.DecompressionBombError:
+        raise ServiceError(413, f"Images are limited to {MAX_IMAGE_PIXELS} pixels") from None
+    except (UnidentifiedImageError, OSError):
+        raise ServiceError(400, "The request body is not a supported image") from None
+    if image.width * image.height > MAX_IMAGE_PIXELS:
+        raise ServiceError(413, f"Images are limited to {MAX_IMAGE_PIXELS} pixels")
+    return image.convert("RGB")
+
+
+def _generate_mosaic(job, body, options):
+    image = _load_image(body)
+    mosaic_data, color_counts = create_mosaic(
+        image, options["size"], PALETTES[options["palette"]], metric=options["metric"],
+        dither=options["dither"], max_colors=options["max_colors"], progress=job.report,
+        raise_errors=True)
+    return mosaic_data, color_counts
+
+
+def _response_job(job, build, body, options):
+    mosaic_data, color_counts = _generate_mosaic(job, body, options)
+    job.report("Rendering", 1.0)
+    return build(mosaic_data, color_counts, options)
+
+
+def _put_page(job, pages, item):
+    """Hand a page to the request thread, giving up once the job is cancelled."""
+    while True:
+        job.report("Rendering pages", job.progress)
+        try:
+            pages.put(item, timeout=0.5)
+            return
+        except queue.Full:
+            pass
+
+
+def _pages_job(job, body, options, pages):
+    mosaic_data, color_counts = _generate_mosaic(job, body, options)
+    page_count = page_layout(mosaic_data, options["plate_size"]).count
+    job.report("Rendering pages", 0.0)
+    for i, page in enumerate(iter_instruction_pages(mosaic_data, options["pixel_size"], options["plate_size"],
+                                                    color_counts)):
+        _put_page(job, pages, page)
+        job.report("Rendering pages", (i + 1) / page_count)
+    _put_page(job, pages, None)
+
+
+class MosaicService:
+    """Request limits, worker pool and response cache shared by all connections.
+
+    Args:
+        workers: Number of worker threads generating and rendering mosaics.
+        max_pending: Requests allowed to be queued or running at once; further requests
+            are refused with 503 until one finishes. Cache hits are always answered.
+        max_upload_bytes: Largest accepted request body.
+        cache_bytes: Memory budget of the response cache.
+        timeout: Seconds a request waits for its result.
+    """
+
+    def __init__(self, workers=None, max_pending=16, max_upload_bytes=MAX_UPLOAD_BYTES,
+                 cache_bytes=128 * 1024 * 1024, timeout=REQUEST_TIMEOUT):
+        self.jobs = JobQueue(workers)
+        self.max_upload_bytes = max_upload_bytes
+        self.timeout = timeout
+        self.cache = LRUCache(max_entries=512, max_bytes=cache_bytes, sizeof=lambda response: len(response[1]))
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._pages_ids = itertools.count()
+
+    def status(self):
+        return {
+            "status": "ok",
+            "jobs": len(self.jobs),
+            "cache": {"entries": len(self.cache), "bytes": self.cache.total_bytes,
+                      "hits": self.cache.hits, "misses": self.cache.misses},
+        }
+
+    def _admit(self):
+        if not self._slots.acquire(blocking=False):
+            raise ServiceError(503, "The server is busy, try again later")
+
+    def _result(self, job):
+        """Wait for a job and return its result, translating failures into ServiceErrors."""
+        if not job.wait(self.timeout):
+            raise ServiceError(503, f"The request did not finish within {self.timeout} seconds")
+        try:
+            return job.result()
+        except (ServiceError, JobCancelled):
+            raise
+        except ValueError as e:
+            raise ServiceError(400, str(e)) from None
+        except Exception as e:
+            logger.exception("Request failed")
+            raise ServiceError(500, f"{type(e).__name__}: {e}") from None
+
+    def respond(self, path, options, body):
+        """Return (content type, payload, cache hit) for a buffered endpoint."""
+        _, build = ENDPOINTS[path]
+        key = (path, hashlib.blake2b(body, digest_size=16).hexdigest(), tuple(sorted(options.items())))
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached + (True,)
+
+        self._admit()
+        job = None
+        try:
+            # Identical requests still in flight share the job through its key
+            job = self.jobs.submit(key, _response_job, build, body, options)
+            return self.cache.put(key, self._result(job)) + (False,)
+        except JobCancelled:
+            raise ServiceError(503, "The request was cancelled") from None
+        finally:
+            self.jobs.release(job)
+            self._slots.release()
+
+    def pages(self, options, body):
+        """Yield (file name, PNG bytes) for every baseplate page as soon as it is rendered.
+
+        Errors before the first page (bad image, busy server) raise ServiceError from the
+        first next() call, while the response status can still be chosen.
+        """
+        self._admit()
+        pages = queue.Queue(maxsize=2)
+        job = None
+        try:
+            job = self.jobs.submit(("pages", next(self._pages_ids)), _pages_job, body, options, pages)
+            while True:
+                try:
+                    item = pages.get(timeout=0.5)
+                except queue.Empty:
+                    if job.done:
+                        # The job ended without its final None, so it failed
+                        self._result(job)
+                        raise ServiceError(500, "Rendering the pages stopped early")
+                    continue
+                if item is None:
+                    return
+                yield item
+        except JobCancelled:
+            raise ServiceError(503, "The request was cancelled") from None
+        finally:
+            self.jobs.release(job)
+            self._slots.release()
+
+
+class _ChunkedWriter:
+    """Write-only file object sending everything written to it as HTTP/1.1 chunks."""
+
+    def __init__(self, wfile):
+        self.wfile = wfile
+
+    def write(self, data):
+        if data:
+            self.wfile.write(b"%x\r\n" % len(data))
+            self.wfile.write(data)
+            self.wfile.write(b"\r\n")
+        return len(data)
+
+    def flush(self):
+        self.wfile.flush()
+
+    def close(self):
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+
+class MosaicRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "MosaicService/1.0"
+
+    @property
+    def service(self):
+        return self.server.service
+
+    def do_GET(self):
+        if urlsplit(self.path).path != "/health":
+            self._send_error(ServiceError(404, "Not found"))
+            return
+        self._send(200, "application/json", json.dumps(self.service.status()).encode("utf-8"))
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        try:
+            if url.path != "/pages" and url.path not in ENDPOINTS:
+                raise ServiceError(404, "Not found")
+            params = {name: values[-1] for name, values in parse_qs(url.query).items()}
+            parse = _parse_pages if url.path == "/pages" else ENDPOINTS[url.path][0]
+            options = parse(params)
+            if params:
+                raise ServiceError(400, f"Unknown parameter: {', '.join(sorted(params))}")
+            body = self._read_body()
+            if url.path == "/pages":
+                self._send_pages(self.service.pages(options, body))
+                return
+            content_type, payload, hit = self.service.respond(url.path, options, body)
+        except ServiceError as e:
+            self._send_error(e)
+            return
+        self._send(200, content_type, payload, {"X-Cache": "hit" if hit else "miss"})
+
+    def _read_body(self):
+        length = self.headers.get("Content-Length")
+        if length is None:
+            raise ServiceError(411, "Send the image as the request body with a Content-Length")
+        try:
+            length = int(length)
+        except ValueError:
+            raise ServiceError(400, "Invalid Content-Length") from None
+        if length > self.service.max_upload_bytes:
+            raise ServiceError(413, f"Uploads are limited to {self.service.max_upload_bytes} bytes")
+        if length <= 0:
+            raise ServiceError(400, "Send the image as the request body")
+        return self.rfile.read(length)
+
+    def _send(self, status, content_type, payload, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        view = memoryview(payload)
+        for start in range(0, len(view), WRITE_CHUNK_SIZE):
+            self.wfile.write(view[start:start + WRITE_CHUNK_SIZE])
+
+    def _send_error(self, error):
+        # The request body may not have been read, so the connection cannot be reused
+        self.close_connection = True
+        self._send(error.status, "application/json", json.dumps({"error": error.message}).encode("utf-8"),
+                   {"Connection": "close"})
+
+    def _send_pages(self, pages):
+        try:
+            first = next(pages)
+        except ServiceError as e:
+            self._send_error(e)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/zip")
+        self.send_header("Content-Disposition", 'attachment; filename="instructions_pages.zip"')
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        writer = _ChunkedWriter(self.wfile)
+        try:
+            write_pages_zip(itertools.chain([first], pages), writer)
+            writer.close()
+        except Exception as e:
+            # Headers are already sent; dropping the connection tells the client the ZIP is incomplete
+            logger.warning("Streaming instruction pages failed: %s", e)
+            self.close_connection = True
+        finally:
+            pages.close()
+
+
+def create_server(host="127.0.0.1", port=8000, **service_options):
+    """Create the HTTP server; call serve_forever() on it to start answering requests."""
+    server = ThreadingHTTPServer((host, port), MosaicRequestHandler)
+    server.service = MosaicService(**service_options)
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve mosaic generation over HTTP.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=None, help="Worker threads (default: number of CPUs)")
+    parser.add_argument("--max-pending", type=int, default=16,
+                        help="Requests queued or running at once before answering 503 (default: 16)")
+    parser.add_argument("--max-upload-mb", type=float, default=MAX_UPLOAD_BYTES / 2 ** 20)
+    parser.add_argument("--cache-mb", type=float, default=128, help="Response cache size (default: 128)")
+    parser.add_argument("--timeout", type=float, default=REQUEST_TIMEOUT, help="Seconds per request")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    server = create_server(args.host, args.port, workers=args.workers, max_pending=args.max_pending,
+                           max_upload_bytes=int(args.max_upload_mb * 2 ** 20),
+                           cache_bytes=int(args.cache_mb * 2 ** 20), timeout=args.timeout)
+    print(f"Serving on http://{args.host}:{server.server_address[1]}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,139 @@
+import json
+import os
+
+import numpy as np
+from PIL import Image
+
+from baseplates import mosaic_dimensions, plan_baseplates
+from encoding import encode_image
+from mosaic import Mosaic
+from palette import get_palette
+from utils import draw_instructions, draw_mosaic, match_pixels
+
+
+class MuralTile:
+    """One baseplate of a mosaic generated tile by tile.
+
+    Attributes:
+        row: Row of the baseplate in the layout.
+        col: Column of the baseplate in the layout.
+        box: (top, left, bottom, right) stud bounds within the whole mosaic.
+        mosaic: Mosaic holding only this baseplate's studs.
+    """
+
+    def __init__(self, row, col, box, mosaic):
+        self.row = row
+        self.col = col
+        self.box = box
+        self.mosaic = mosaic
+
+
+def _open_source(image, width, height):
+    """Open a source image given as a PIL image or a path, in RGB mode."""
+    if isinstance(image, (str, os.PathLike)):
+        image = Image.open(image)
+        # JPEGs can be decoded at a reduced scale that is still at least the mosaic size
+        image.draft("RGB", (width, height))
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    return image
+
+
+def iter_mosaic_tiles(image, mosaic_size, lego_colors, matching="search", metric="rgb"):
+    """Generate a mosaic one baseplate at a time.
+
+    Every tile is resized straight from its region of the source image, so neither the
+    resized image nor the index grid of the whole mosaic is ever held in memory. The
+    result matches a single resize of the whole image up to rounding.
+
+    Args:
+        image: PIL image or path of the source image.
+        mosaic_size: Mosaic size in studs, as an int (square) or a (width, height) pair.
+        lego_colors: Palette to match against.
+        matching: Color matching method (see utils.MATCHING_METHODS).
+        metric: Color distance metric.
+
+    Yields:
+        MuralTile for every baseplate, in row-major layout order.
+    """
+    width, height = mosaic_dimensions(mosaic_size)
+    source = _open_source(image, width, height)
+    palette = get_palette(lego_colors)
+    scale_x = source.width / width
+    scale_y = source.height / height
+
+    for row, col, (top, left, bottom, right) in plan_baseplates(width, height).tiles():
+        region = (left * scale_x, top * scale_y, right * scale_x, bottom * scale_y)
+        tile_image = source.resize((right - left, bottom - top), Image.Resampling.LANCZOS, box=region)
+        indices = match_pixels(np.asarray(tile_image), palette, matching, metric)
+        yield MuralTile(row, col, (top, left, bottom, right), Mosaic(indices, palette))
+
+
+def stream_mural(image, mosaic_size, lego_colors, out_dir, preview_pixel_size=10,
+                 instructions_pixel_size=24, matching="search", metric="rgb"):
+    """Generate, render and write a large mosaic one baseplate at a time.
+
+    For every baseplate this writes ``preview_rRR_cCC.png`` and ``instructions_rRR_cCC.png``
+    to ``out_dir``; ``manifest.json`` with the layout, color numbers and total color counts
+    is written after the last tile. Peak memory depends on the baseplate size, not on the
+    mosaic size. Colors are numbered in the order they first appear, so a number printed
+    on an earlier page never changes.
+
+    Args:
+        image: PIL image or path of the source image.
+        mosaic_size: Mosaic size in studs, as an int (square) or a (width, height) pair.
+        lego_colors: Palette to match against.
+        out_dir: Directory the pages are written to (created if missing).
+        preview_pixel_size: Pixels per stud in the preview tiles.
+        instructions_pixel_size: Pixels per stud on the instruction pages.
+        matching: Color matching method (see utils.MATCHING_METHODS).
+        metric: Color distance metric.
+
+    Yields:
+        Progress dict per tile with row, col, box, tiles_done, tiles_total, preview_path
+        and instructions_path.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    width, height = mosaic_dimensions(mosaic_size)
+    layout = plan_baseplates(width, height)
+    color_counts = {}
+    color_numbers = {}
+
+    tiles = iter_mosaic_tiles(image, (width, height), lego_colors, matching, metric)
+    for tiles_done, tile in enumerate(tiles, 1):
+        tile_counts = tile.mosaic.color_counts()
+        for color_name, count in tile_counts.items():
+            color_numbers.setdefault(color_name, len(color_numbers) + 1)
+            color_counts[color_name] = color_counts.get(color_name, 0) + count
+
+        stem = f"r{tile.row:02d}_c{tile.col:02d}"
+        preview_path = os.path.join(out_dir, f"preview_{stem}.png")
+        with open(preview_path, "wb") as f:
+            f.write(encode_image(draw_mosaic(tile.mosaic, preview_pixel_size)))
+        instructions_path = os.path.join(out_dir, f"instructions_{stem}.png")
+        page = draw_instructions(tile.mosaic, instructions_pixel_size, tile_counts, lego_colors,
+                                 color_numbers=color_numbers)
+        with open(instructions_path, "wb") as f:
+            f.write(encode_image(page))
+
+        yield {
+            "row": tile.row,
+            "col": tile.col,
+            "box": tile.box,
+            "tiles_done": tiles_done,
+            "tiles_total": layout.count,
+            "preview_path": preview_path,
+            "instructions_path": instructions_path,
+        }
+
+    manifest = {
+        "width": width,
+        "height": height,
+        "plate_size": layout.plate_size,
+        "rows": layout.rows,
+        "columns": layout.columns,
+        "color_numbers": color_numbers,
+        "color_counts": color_counts,
+    }
+    with open(os.path.join(out_dir, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=2)
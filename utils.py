@@ -1,16 +1,61 @@
 import streamlit as st
 import numpy as np
+import pandas as pd
 from PIL import Image, ImageDraw
-import io
-import math
+import os
 import base64
+import hashlib
+import typing
+import collections.abc
 import streamlit as st
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
 from datetime import datetime
-from io import BytesIO
-from sklearn.cluster import KMeans
+from functools import lru_cache
+from palette import Palette, get_palette
+from mosaic import Mosaic, as_mosaic
+from cache import LRUCache
+from color_lut import get_color_lut
+from palette_index import PaletteIndex, get_palette_index
+from dither import error_diffusion, ordered_dither
+from palette_reduction import reduce_palette
+from inventory import assign_with_inventory
+from baseplates import mosaic_dimensions, plan_baseplates
+from encoding import IMAGE_MIME_TYPES, PNG_COMPRESS_LEVEL, encode_image
+from jobs import JobCancelled, get_job_queue
+from analytics import GoogleSheetsSink, get_event_logger
+
+
+
+# Color matching methods: exhaustive search, lookup table refined to the exact result,
+# and lookup table only (fastest, may differ near bin boundaries)
+MATCHING_METHODS = ("search", "lut", "lut-approx")
+
+# Lookup table resolution and optional directory to keep built tables across restarts.
+# 6 bits halves the pixels that need refining but takes about 8x longer to build.
+LUT_BITS = int(os.environ.get("MOSAIC_LUT_BITS", "5"))
+LUT_CACHE_DIR = os.environ.get("MOSAIC_LUT_CACHE_DIR")
+
+def match_pixels(pixel_data, palette, matching="search", metric="rgb"):
+    """Assign every pixel in an (..., 3) RGB array to a palette index.
 
+    Args:
+        pixel_data: Array of shape (..., 3) holding RGB values.
+        palette: Compiled Palette.
+        matching: Method used for the RGB metric, one of MATCHING_METHODS.
+        metric: Color distance, one of palette_index.METRICS. Perceptual metrics use a
+            KD-tree index over the palette's CIELAB coordinates.
+    """
+    if metric != "rgb":
+        return get_palette_index(palette, metric).match(pixel_data)
+    if matching == "search":
+        return palette.match(pixel_data)
+    if matching in ("lut", "lut-approx"):
+        lut = get_color_lut(palette, LUT_BITS, LUT_CACHE_DIR)
+        return lut.match(pixel_data, exact=matching == "lut")
+    raise ValueError(f"Unknown matching method: {matching}")
+
+def match_lego_colors(pixel_data, lego_colors):
+    """Assign every pixel in an (..., 3) RGB array to its closest LEGO color index."""
+    return get_palette(lego_colors).match(pixel_data)
 
 
 def find_closest_lego_color(r, g, b, lego_colors):
@@ -25,29 +70,83 @@ def find_closest_lego_color(r, g, b, lego_colors):
     except (ValueError, TypeError):
         # If conversion fails, use default values
         r, g, b = 0, 0, 0
-        
-    min_distance = float('inf')
-    closest_color = lego_colors[0]  # Default to first color
-    
-    for color in lego_colors:
-        try:
-            name, hex_color, cr, cg, cb = color[:5]
-            # Ensure color values are numeric
-            cr, cg, cb = float(cr), float(cg), float(cb)
-            distance = math.sqrt((r - cr) ** 2 + (g - cg) ** 2 + (b - cb) ** 2)
-            
-            if distance < min_distance:
-                min_distance = distance
-                closest_color = color
-        except (ValueError, TypeError, IndexError):
-            # Skip this color if there's an error
-            continue
-            
-    return closest_color
-
-def create_mosaic(image, mosaic_size, lego_colors):
+
+    index = match_lego_colors(np.array([r, g, b]), lego_colors)
+    return lego_colors[int(index)]
+
+# Generated mosaics keyed by image digest, size and palette, shared by all sessions
+_MOSAIC_CACHE = LRUCache(
+    max_entries=256,
+    max_bytes=64 * 1024 * 1024,
+    sizeof=lambda result: result[0].nbytes,
+    ttl=6 * 60 * 60,
+)
+
+def image_digest(image):
+    """Return a hex digest of an image's decoded pixel data, mode and size."""
+    hasher = hashlib.blake2b(digest_size=16)
+    hasher.update(repr((image.mode, image.size)).encode())
+    hasher.update(image.tobytes())
+    return hasher.hexdigest()
+
+def _mosaic_options(matching="search", metric="rgb", dither=None, max_colors=None, stock=None,
+                    strict_stock=False):
+    return {"matching": matching, "metric": metric, "dither": dither, "max_colors": max_colors,
+            "stock": tuple(sorted(dict(stock).items())) if stock else None, "strict_stock": strict_stock}
+
+def mosaic_key(image, mosaic_size, lego_colors, **options):
+    """Key identifying a create_mosaic request, for caching and deduplicating generation."""
+    options = _mosaic_options(**options)
+    return (image_digest(image), mosaic_size, get_palette(lego_colors).key, tuple(options.items()))
+
+def create_mosaic(image, mosaic_size, lego_colors, use_cache=True, matching="search", metric="rgb",
+                  dither=None, max_colors=None, stock=None, strict_stock=False, progress=None,
+                  raise_errors=False):
+    """Create a LEGO mosaic from an image, reusing the result of identical earlier requests.
+
+    Args:
+        image: PIL image to convert.
+        mosaic_size: Mosaic size in studs, as an int (square) or a (width, height) pair.
+        lego_colors: LEGO palette to build from.
+        use_cache: Reuse mosaics generated earlier in this process for the same inputs.
+        matching: Color matching method, one of MATCHING_METHODS.
+        metric: Color distance, one of palette_index.METRICS ("rgb", "lab" or "ciede2000").
+        dither: None, or a dithering mode from dither.DITHER_MODES.
+        max_colors: Limit the mosaic to this many palette colors (None uses all of them).
+        stock: Optional dict of elementId -> plates available. Studs are then assigned by
+            the inventory solver, whose solve time and error end up in ``Mosaic.stats``.
+        strict_stock: Treat colors missing from ``stock`` as unavailable instead of unlimited.
+        progress: Optional callable taking (stage, fraction), called between generation steps.
+        raise_errors: Raise generation errors instead of reporting them with st.error.
+
+    Returns:
+        (Mosaic, color_counts) tuple, or (None, None) if generation failed.
+    """
+    options = _mosaic_options(matching, metric, dither, max_colors, stock, strict_stock)
+    run_options = dict(options, progress=progress, raise_errors=raise_errors)
+    if not use_cache or lego_colors is None or len(lego_colors) == 0:
+        return _create_mosaic(image, mosaic_size, lego_colors, **run_options)
+
+    try:
+        key = mosaic_key(image, mosaic_size, lego_colors, **options)
+    except Exception:
+        return _create_mosaic(image, mosaic_size, lego_colors, **run_options)
+
+    cached = _MOSAIC_CACHE.get(key)
+    if cached is None:
+        mosaic_data, color_counts = _create_mosaic(image, mosaic_size, lego_colors, **run_options)
+        if mosaic_data is None:
+            return None, None
+        cached = _MOSAIC_CACHE.put(key, (mosaic_data, color_counts))
+    # Mosaics are read-only, but callers get their own copy of the counts
+    return cached[0], dict(cached[1])
+
+def _create_mosaic(image, mosaic_size, lego_colors, matching="search", metric="rgb", dither=None,
+                   max_colors=None, stock=None, strict_stock=False, progress=None, raise_errors=False):
     """Create a LEGO mosaic from an image with robust error handling."""
+    report = progress or (lambda stage, fraction: None)
     try:
+        report("Resizing image", 0.0)
         # Make a copy to avoid modifying the original
         img_copy = image.copy()
 
@@ -55,14 +154,16 @@ def create_mosaic(image, mosaic_size, lego_colors):
         if img_copy.mode != 'RGB':
             img_copy = img_copy.convert('RGB')
 
+        width, height = mosaic_dimensions(mosaic_size)
+
         # Try different resize methods if one fails
         try:
-            img_resized = img_copy.resize((mosaic_size, mosaic_size), Image.Resampling.LANCZOS)
+            img_resized = img_copy.resize((width, height), Image.Resampling.LANCZOS)
         except (AttributeError, Exception):
             try:
-                img_resized = img_copy.resize((mosaic_size, mosaic_size), Image.LANCZOS)
+                img_resized = img_copy.resize((width, height), Image.LANCZOS)
             except (AttributeError, Exception):
-                img_resized = img_copy.resize((mosaic_size, mosaic_size), Image.NEAREST)
+                img_resized = img_copy.resize((width, height), Image.NEAREST)
 
         # Convert to numpy array for efficient processing
         pixel_data = np.array(img_resized)
@@ -79,118 +180,213 @@ def create_mosaic(image, mosaic_size, lego_colors):
                 ["Green", "#237841", 35, 120, 65]
             ]
 
-        # Create the mosaic
-        mosaic_data = []
-        color_counts = {}
-
         # Verify pixel_data dimensions
-        if pixel_data.shape[0] != mosaic_size or pixel_data.shape[1] != mosaic_size:
+        if pixel_data.shape[0] != height or pixel_data.shape[1] != width:
             st.warning(f"Resized image dimensions don't match requested size: {pixel_data.shape}")
-            # Resize again or handle the issue
-
-        # Process each row and column with bounds checking
-        for y in range(min(mosaic_size, pixel_data.shape[0])):
-            row = []
-            for x in range(min(mosaic_size, pixel_data.shape[1])):
-                # Get pixel color with bounds checking
-                try:
-                    r, g, b = pixel_data[y, x]
-                except (IndexError, ValueError):
-                    r, g, b = 0, 0, 0  # Default to black if error
-
-                lego_color = find_closest_lego_color(r, g, b, lego_colors)
-                row.append(lego_color)
-
-                color_name = lego_color[0]
-                color_counts[color_name] = color_counts.get(color_name, 0) + 1
 
-            mosaic_data.append(row)
+        # Match all pixels at once into a compact index grid
+        palette = get_palette(lego_colors)
+        pixel_data = pixel_data[:height, :width, :3]
+
+        # Optionally restrict matching to the best max_colors palette colors
+        selected = None
+        match_palette = palette
+
+        def match(pixels):
+            return match_pixels(pixels, palette, matching, metric)
+
+        if max_colors and max_colors < len(palette):
+            report("Choosing colors", 0.1)
+            selected = reduce_palette(pixel_data, palette, max_colors, match)
+            match_palette = Palette([palette.colors[i] for i in selected])
+            # Every image picks its own subset, so match against it directly instead of
+            # building a process-wide index or lookup table for each subset
+            if metric == "rgb":
+                match = match_palette.match
+            else:
+                match = PaletteIndex(match_palette, metric).match
+
+        report("Matching colors", 0.2)
+        stats = {}
+        if stock:
+            if dither is not None:
+                raise ValueError("Dithering cannot be combined with stock limits")
+            indices, stats = assign_with_inventory(pixel_data, match_palette, dict(stock), strict_stock,
+                                                   metric="rgb" if metric == "rgb" else "lab")
+        elif dither == "floyd-steinberg":
+            indices = error_diffusion(pixel_data, match_palette, match)
+        elif dither == "ordered":
+            indices = match(ordered_dither(pixel_data, match_palette))
+        elif dither is None:
+            # Match one baseplate at a time so working memory stays bounded for large murals
+            indices = np.empty(pixel_data.shape[:2], dtype=palette.index_dtype)
+            layout = plan_baseplates(width, height)
+            for done, (_, _, (top, left, bottom, right)) in enumerate(layout.tiles()):
+                report("Matching colors", 0.2 + 0.7 * done / layout.count)
+                indices[top:bottom, left:right] = match(pixel_data[top:bottom, left:right])
+        else:
+            raise ValueError(f"Unknown dithering mode: {dither}")
+
+        report("Counting bricks", 0.9)
+        if selected is not None:
+            indices = selected[indices]
+        mosaic_data = Mosaic(indices, palette, stats)
+        color_counts = mosaic_data.color_counts()
 
         return mosaic_data, color_counts
 
+    except JobCancelled:
+        raise
     except Exception as e:
+        if raise_errors:
+            raise
         st.error(f"Error creating mosaic: {str(e)}")
         return None, None
 
+def _mosaic_job(job, image, mosaic_size, lego_colors, **options):
+    result = create_mosaic(image, mosaic_size, lego_colors, progress=job.report, raise_errors=True,
+                           **options)
+    job.report("Done", 1.0)
+    return result
+
+def submit_mosaic_job(image, mosaic_size, lego_colors, **options):
+    """Generate a mosaic on the process-wide job queue.
+
+    Identical requests that are still running share one job. Release the returned Job
+    with ``get_job_queue().release(job)`` to cancel it once its result is no longer wanted.
+
+    Args:
+        image, mosaic_size, lego_colors: As for create_mosaic.
+        **options: create_mosaic generation options (matching, metric, dither, max_colors,
+            stock, strict_stock).
+
+    Returns:
+        Job whose result is the (Mosaic, color_counts) tuple.
+    """
+    key = ("mosaic",) + mosaic_key(image, mosaic_size, lego_colors, **options)
+    return get_job_queue().submit(key, _mosaic_job, image, mosaic_size, lego_colors, **options)
+
+def _expand_cells(cells, pixel_size):
+    """Block-expand a (rows, cols, ...) array so every cell becomes a pixel_size square."""
+    rows, cols = cells.shape[:2]
+    expanded = np.broadcast_to(
+        cells[:, None, :, None],
+        (rows, pixel_size, cols, pixel_size) + cells.shape[2:],
+    )
+    return expanded.reshape((rows * pixel_size, cols * pixel_size) + cells.shape[2:])
+
+def _assemble_tiles(cell_tiles):
+    """Lay out a (rows, cols, tile_h, tile_w, ...) array of per-cell tiles as one image array."""
+    rows, cols, tile_h, tile_w = cell_tiles.shape[:4]
+    channels = cell_tiles.shape[4:]
+    return cell_tiles.swapaxes(1, 2).reshape((rows * tile_h, cols * tile_w) + channels)
+
 def draw_mosaic(mosaic_data, pixel_size=20):
     """Draw the mosaic and return as an image."""
+    mosaic_data = as_mosaic(mosaic_data)
     if not mosaic_data:
         return None
-        
-    mosaic_size = len(mosaic_data)
-    
-    # Create a new image with white background
-    img_width = mosaic_size * pixel_size
-    img_height = mosaic_size * pixel_size
-    image = Image.new('RGB', (img_width, img_height), color='white')
-    draw = ImageDraw.Draw(image)
-    
-    # Draw the mosaic
-    for y in range(mosaic_size):
-        for x in range(mosaic_size):
-            color = mosaic_data[y][x]
-            hex_color = color[1]  # Use hex color
-            
-            # Convert hex to RGB
-            r, g, b = int(hex_color[1:3], 16), int(hex_color[3:5], 16), int(hex_color[5:7], 16)
-            
-            # Draw filled rectangle
-            x1 = x * pixel_size
-            y1 = y * pixel_size
-            x2 = x1 + pixel_size - 1
-            y2 = y1 + pixel_size - 1
-            draw.rectangle([(x1, y1), (x2, y2)], fill=(r, g, b))
-    
-    return image
 
-def draw_mosaic_with_dots(mosaic_data, pixel_size=20):
+    # Look up every stud color at once, then scale each stud up to a pixel_size block.
+    # The filled rectangles of the per-stud drawing covered their whole cell, so the
+    # blocks tile the image without gaps.
+    stud_colors = mosaic_data.palette.rgb[mosaic_data.indices]
+    return Image.fromarray(_expand_cells(stud_colors, pixel_size), 'RGB')
+
+@lru_cache(maxsize=32)
+def _dot_mask(pixel_size, antialias=True):
+    """Rasterize the circle stamp for one cell once per pixel_size, as a 0-255 coverage mask."""
+    # Supersample and box-filter down for smooth edges; a scale of 1 gives the hard edge
+    # that ImageDraw.ellipse draws directly.
+    scale = 4 if antialias else 1
+    size = pixel_size * scale
+    stamp = Image.new('L', (size, size), 0)
+    ImageDraw.Draw(stamp).ellipse([(0, 0), (size - 1, size - 1)], fill=255)
+    if scale > 1:
+        stamp = stamp.reduce(scale)
+    mask = np.array(stamp, dtype=np.uint16)
+    mask.setflags(write=False)
+    return mask
+
+def draw_mosaic_with_dots(mosaic_data, pixel_size=20, antialias=True):
     """
     Draws a mosaic where each cell is a black square filled with a full-sized colored dot (circle).
     
     Args:
-        mosaic_data: 2D list of LEGO color tuples.
+        mosaic_data: Mosaic (or legacy 2D list of LEGO color tuples).
         pixel_size: Size of each mosaic block and diameter of each dot.
+        antialias: Smooth the dot edges; False reproduces hard-edged ellipses.
     
     Returns:
         PIL.Image of the drawn mosaic.
     """
+    mosaic_data = as_mosaic(mosaic_data)
     if not mosaic_data:
         return None
 
-    mosaic_size = len(mosaic_data)
-    img_width = mosaic_size * pixel_size
-    img_height = mosaic_size * pixel_size
-
-    image = Image.new('RGB', (img_width, img_height), color='black')
-    draw = ImageDraw.Draw(image)
-
-    for y in range(mosaic_size):
-        for x in range(mosaic_size):
-            color = mosaic_data[y][x]
-            hex_color = color[1]
-
-            r, g, b = int(hex_color[1:3], 16), int(hex_color[3:5], 16), int(hex_color[5:7], 16)
-
-            # Full-size circle within the square cell
-            x1 = x * pixel_size
-            y1 = y * pixel_size
-            x2 = x1 + pixel_size - 1
-            y2 = y1 + pixel_size - 1
-
-            draw.ellipse([(x1, y1), (x2, y2)], fill=(r, g, b))
-
-    return image
-
-
-def draw_instructions(mosaic_data, pixel_size=24, color_counts=None, lego_colors_used=None):
-    """Draw the building instructions and return as an image."""
+    # Stamp the circle mask onto every palette color once (a handful of small tiles),
+    # then assemble the image by gathering one tile per stud.
+    palette_rgb = mosaic_data.palette.rgb.astype(np.uint16)
+    mask = _dot_mask(pixel_size, antialias)
+    dot_tiles = ((palette_rgb[:, None, None, :] * mask[None, :, :, None] + 127) // 255).astype(np.uint8)
+    return Image.fromarray(_assemble_tiles(dot_tiles[mosaic_data.indices]), 'RGB')
+
+
+def _draw_instruction_cell(draw, x1, y1, pixel_size, fill, text_color, color_number):
+    """Draw one outlined instruction cell with its color number centered in it."""
+    x2 = x1 + pixel_size - 1
+    y2 = y1 + pixel_size - 1
+    draw.rectangle([(x1, y1), (x2, y2)], fill=tuple(fill), outline=(0, 0, 0))
+
+    # Draw color number
+    number_text = str(color_number)
+    text_width = 6 * len(number_text)  # Approximation
+    text_height = 10  # Approximation
+    text_x = x1 + (pixel_size - text_width) // 2
+    text_y = y1 + (pixel_size - text_height) // 2  # Center in the cell
+    draw.text((text_x, text_y), number_text, fill=text_color)
+
+def _instruction_tiles(palette, color_to_number, pixel_size, used_indices):
+    """Pre-render one numbered instruction cell per used palette color.
+
+    The default font is anti-aliased against the cell color, so every color gets its own
+    tile rather than sharing black and white glyphs. Returns a (colors, pixel_size,
+    pixel_size, 3) uint8 array, or None if a number would not fit inside its cell.
+    """
+    tiles = np.zeros((len(palette), pixel_size, pixel_size, 3), dtype=np.uint8)
+    tile = Image.new('RGB', (pixel_size, pixel_size))
+    draw = ImageDraw.Draw(tile)
+    for color_index in used_indices.tolist():
+        color_number = color_to_number.get(palette.names[color_index], 0)
+        number_text = str(color_number)
+        text_x = (pixel_size - 6 * len(number_text)) // 2
+        text_y = (pixel_size - 10) // 2
+        left, top, right, bottom = draw.textbbox((text_x, text_y), number_text)
+        if left < 0 or top < 0 or right > pixel_size or bottom > pixel_size:
+            return None
+
+        _draw_instruction_cell(draw, 0, 0, pixel_size, palette.rgb[color_index].tolist(),
+                               palette.text_rgb[color_index], color_number)
+        tiles[color_index] = np.asarray(tile)
+    return tiles
+
+def draw_instructions(mosaic_data, pixel_size=24, color_counts=None, lego_colors_used=None,
+                      color_numbers=None):
+    """Draw the building instructions and return as an image.
+
+    Colors are numbered in the order of ``color_counts`` unless ``color_numbers`` maps
+    color names to fixed numbers, e.g. to share one numbering across the pages of a mural.
+    """
+    mosaic_data = as_mosaic(mosaic_data)
     if not mosaic_data:
         return None
         
-    mosaic_size = len(mosaic_data)
+    palette_rgb = mosaic_data.palette.rgb.tolist()
+    palette_names = mosaic_data.palette.names
+    palette_text_rgb = mosaic_data.palette.text_rgb
     
     # Calculate the main grid height and the legend height
-    grid_height = mosaic_size * pixel_size
+    grid_height = mosaic_data.height * pixel_size
     legend_height = 0
     
     # Add space for color legend if provided
@@ -201,48 +397,33 @@ def draw_instructions(mosaic_data, pixel_size=24, color_counts=None, lego_colors
         legend_height = legend_rows * 25 + 40  # 25px per row + 40px padding/header
     
     # Create a new image with white background including space for the legend
-    img_width = mosaic_size * pixel_size
+    img_width = mosaic_data.width * pixel_size
     img_height = grid_height + legend_height
     image = Image.new('RGB', (img_width, img_height), color='white')
     draw = ImageDraw.Draw(image)
     
     # Create a mapping of colors to numbers
     color_to_number = {}
-    if color_counts:
+    if color_numbers is not None:
+        color_to_number = dict(color_numbers)
+    elif color_counts:
         for i, color_name in enumerate(color_counts.keys()):
             color_to_number[color_name] = i + 1  # Start numbering from 1
     
-    # Draw the mosaic with color numbers
-    for y in range(mosaic_size):
-        for x in range(mosaic_size):
-            color = mosaic_data[y][x]
-            color_name = color[0]
-            hex_color = color[1]  # Use hex color
-            
-            # Convert hex to RGB
-            r, g, b = int(hex_color[1:3], 16), int(hex_color[3:5], 16), int(hex_color[5:7], 16)
-            
-            # Draw filled rectangle
-            x1 = x * pixel_size
-            y1 = y * pixel_size
-            x2 = x1 + pixel_size - 1
-            y2 = y1 + pixel_size - 1
-            draw.rectangle([(x1, y1), (x2, y2)], fill=(r, g, b), outline=(0, 0, 0))
-            
-            # Add color number text (adjust text color for visibility)
-            brightness = (r * 299 + g * 587 + b * 114) / 1000
-            text_color = (0, 0, 0) if brightness > 128 else (255, 255, 255)
-            
-            # Get the number for this color
-            color_number = color_to_number.get(color_name, 0)
-            
-            # Draw color number
-            number_text = str(color_number)
-            text_width = 6 * len(number_text)  # Approximation
-            text_height = 10  # Approximation
-            text_x = x1 + (pixel_size - text_width) // 2
-            text_y = y1 + (pixel_size - text_height) // 2  # Center in the cell
-            draw.text((text_x, text_y), number_text, fill=text_color)
+    cell_tiles = _instruction_tiles(mosaic_data.palette, color_to_number, pixel_size,
+                                    np.unique(mosaic_data.indices))
+    if cell_tiles is not None:
+        # Paste the whole grid at once from the pre-rendered numbered cells
+        grid = _assemble_tiles(cell_tiles[mosaic_data.indices])
+        image.paste(Image.fromarray(grid, 'RGB'), (0, 0))
+    else:
+        # Numbers wider than their cell overlap the neighbouring cells, which only the
+        # cell-by-cell drawing order reproduces
+        for y, index_row in enumerate(mosaic_data.indices.tolist()):
+            for x, color_index in enumerate(index_row):
+                _draw_instruction_cell(draw, x * pixel_size, y * pixel_size, pixel_size,
+                                       palette_rgb[color_index], palette_text_rgb[color_index],
+                                       color_to_number.get(palette_names[color_index], 0))
     
     # Add color legend if provided
     if color_counts and lego_colors_used:
@@ -253,10 +434,11 @@ def draw_instructions(mosaic_data, pixel_size=24, color_counts=None, lego_colors
         col_width = img_width // 4
         row_height = 25
         
+        palette = get_palette(lego_colors_used)
         i = 0
         for color_name, count in color_counts.items():
-            color_info = next((c for c in lego_colors_used if c[0] == color_name), None)
-            if color_info:
+            color_index = palette.name_to_index.get(color_name)
+            if color_index is not None:
                 col = i % 4
                 row = i // 4
                 
@@ -265,14 +447,12 @@ def draw_instructions(mosaic_data, pixel_size=24, color_counts=None, lego_colors
                 y_pos = grid_height + 35 + (row * row_height)
                 
                 # Draw color square
-                hex_color = color_info[1]
-                r, g, b = int(hex_color[1:3], 16), int(hex_color[3:5], 16), int(hex_color[5:7], 16)
+                r, g, b = (int(v) for v in palette.rgb[color_index])
                 draw.rectangle([(x_pos, y_pos), (x_pos + 15, y_pos + 15)], fill=(r, g, b), outline=(0, 0, 0))
                 
                 # Draw color number inside square
                 color_number = color_to_number.get(color_name, 0)
-                brightness = (r * 299 + g * 587 + b * 114) / 1000
-                number_color = (0, 0, 0) if brightness > 128 else (255, 255, 255)
+                number_color = palette.text_rgb[color_index]
                 draw.text((x_pos + 4, y_pos + 2), str(color_number), fill=number_color)
                 
                 # Draw color name and count
@@ -282,124 +462,213 @@ def draw_instructions(mosaic_data, pixel_size=24, color_counts=None, lego_colors
     
     return image
 
-def get_image_download_link(img, filename, text):
+def get_image_download_link(img, filename, text, fmt="png"):
     """Generate a download link for an image."""
     if img is None:
         return ""
         
-    buffered = io.BytesIO()
-    img.save(buffered, format="PNG")
-    img_str = base64.b64encode(buffered.getvalue()).decode()
-    href = f'<a href="data:image/png;base64,{img_str}" download="{filename}">{text}</a>'
+    img_str = base64.b64encode(encode_image(img, fmt)).decode()
+    href = f'<a href="data:{IMAGE_MIME_TYPES[fmt]};base64,{img_str}" download="{filename}">{text}</a>'
     return href
 
-def instructions_img_to_bytes(img):
-    buf = BytesIO()
-    img.save(buf, format="PNG")
-    return buf.getvalue()
+def instructions_img_to_bytes(img, fmt="png", palette_mode=True, compress_level=None):
+    """Encode an image for download (see encoding.encode_image)."""
+    return encode_image(img, fmt, palette_mode, compress_level)
+
+
+RENDERERS = {
+    "mosaic": draw_mosaic,
+    "dots": draw_mosaic_with_dots,
+    "instructions": draw_instructions,
+}
+
+# Rendered images, shared by all sessions in the process
+_RENDER_CACHE = LRUCache(
+    max_entries=64,
+    max_bytes=256 * 1024 * 1024,
+    sizeof=lambda img: 0 if img is None else img.width * img.height * len(img.getbands()),
+)
 
+# Largest side in pixels of a view rendered for display; larger mosaics get smaller studs,
+# so two views of the largest custom mosaics still fit in the render cache together
+MAX_DISPLAY_SIDE = 4096
+
+def fit_pixel_size(mosaic_data, pixel_size, max_side=MAX_DISPLAY_SIDE):
+    """Largest stud size up to ``pixel_size`` that keeps a rendered view within ``max_side`` pixels."""
+    mosaic_data = as_mosaic(mosaic_data)
+    return max(1, min(pixel_size, max_side // max(mosaic_data.width, mosaic_data.height, 1)))
+
+# Encoded downloads of the rendered images, keyed by render key and encoding options
+_ENCODED_CACHE = LRUCache(max_entries=128, max_bytes=128 * 1024 * 1024, sizeof=len)
+
+def _encoding_key(fmt="png", palette_mode=True, compress_level=None):
+    if fmt != "png":
+        return (fmt,)
+    return (fmt, palette_mode, PNG_COMPRESS_LEVEL if compress_level is None else compress_level)
+
+# Encoding used for downloads unless callers ask for another one
+DEFAULT_ENCODING = _encoding_key()
+
+def _render_key(kind, mosaic_data, pixel_size, color_counts, lego_colors_used):
+    key = (kind, mosaic_data.digest, pixel_size)
+    if kind == "instructions":
+        legend_key = get_palette(lego_colors_used).key if lego_colors_used else None
+        key += (tuple(color_counts.items()) if color_counts else None, legend_key)
+    return key
+
+def prime_render_cache(kind, mosaic_data, pixel_size, image, png_bytes,
+                       color_counts=None, lego_colors_used=None):
+    """Store an already rendered view so later render_cached calls with the same inputs reuse it.
+
+    ``png_bytes`` must have been encoded with DEFAULT_ENCODING.
+    """
+    key = _render_key(kind, as_mosaic(mosaic_data), pixel_size, color_counts, lego_colors_used)
+    _RENDER_CACHE.put(key, image)
+    _ENCODED_CACHE.put(key + DEFAULT_ENCODING, png_bytes)
+
+def render_cached(kind, mosaic_data, pixel_size, color_counts=None, lego_colors_used=None,
+                  fmt="png", palette_mode=True, compress_level=None):
+    """Render a mosaic view and encode it, reusing earlier results for identical inputs.
+
+    Args:
+        kind: One of the RENDERERS keys ("mosaic", "dots" or "instructions").
+        mosaic_data: Mosaic to render.
+        pixel_size: Size of each stud in pixels.
+        color_counts: Color counts for the instruction numbering and legend.
+        lego_colors_used: Palette for the instruction legend.
+        fmt, palette_mode, compress_level: Encoding options (see encoding.encode_image).
+
+    Returns:
+        (image, encoded_bytes) tuple. The image is shared between callers and must not be modified.
+    """
+    mosaic_data = as_mosaic(mosaic_data)
+    img = render_image_cached(kind, mosaic_data, pixel_size, color_counts, lego_colors_used)
+    if img is None:
+        return None, b""
+
+    key = _render_key(kind, mosaic_data, pixel_size, color_counts, lego_colors_used)
+    encoded = _ENCODED_CACHE.get_or_create(
+        key + _encoding_key(fmt, palette_mode, compress_level),
+        lambda: instructions_img_to_bytes(img, fmt, palette_mode, compress_level))
+    return img, encoded
+
+def render_image_cached(kind, mosaic_data, pixel_size, color_counts=None, lego_colors_used=None):
+    """Render a mosaic view without encoding it, reusing earlier results for identical inputs."""
+    mosaic_data = as_mosaic(mosaic_data)
+    if not mosaic_data:
+        return None
+
+    def render():
+        if kind == "instructions":
+            return draw_instructions(mosaic_data, pixel_size, color_counts=color_counts,
+                                     lego_colors_used=lego_colors_used)
+        return RENDERERS[kind](mosaic_data, pixel_size)
+
+    key = _render_key(kind, mosaic_data, pixel_size, color_counts, lego_colors_used)
+    return _RENDER_CACHE.get_or_create(key, render)
+
+def _download_accepts_callable():
+    """True if st.download_button's ``data`` parameter is annotated to accept a callable."""
+    try:
+        data_type = typing.get_type_hints(st.download_button).get("data")
+    except Exception:
+        return False
+    return any(typing.get_origin(option) is collections.abc.Callable
+               for option in typing.get_args(data_type) or (data_type,))
+
+# Streamlit versions that accept a callable as download data generate it only on click
+_DOWNLOAD_ACCEPTS_CALLABLE = _download_accepts_callable()
+
+def deferred_download(payload):
+    """Prepare download data so it is only produced when the user clicks.
+
+    Args:
+        payload: Zero-argument callable returning the file contents.
+
+    Returns:
+        ``payload`` itself where st.download_button accepts callables, otherwise its result.
+    """
+    return payload if _DOWNLOAD_ACCEPTS_CALLABLE else payload()
+
+def lazy_render_download(kind, mosaic_data, pixel_size, color_counts=None, lego_colors_used=None,
+                         fmt="png", palette_mode=True, compress_level=None):
+    """Download data for a rendered view that is only encoded when the user clicks."""
+    return deferred_download(lambda: render_cached(kind, mosaic_data, pixel_size, color_counts,
+                                                   lego_colors_used, fmt, palette_mode,
+                                                   compress_level)[1])
+
+
+def shopping_list(color_counts, lego_colors, mosaic_size=None):
+    """Build the shopping list of a mosaic, most needed pieces first.
+
+    Args:
+        color_counts: Studs per color name.
+        lego_colors: Palette the mosaic was built from.
+        mosaic_size: Mosaic size (int or (width, height)); adds the baseplates needed to tile it.
+
+    Returns:
+        DataFrame with "Color Name", "quantity", "Color Preview" (hex) and "elementId" columns.
+    """
+    palette = get_palette(lego_colors)
+    shopping_data = []
+    for color_name, count in color_counts.items():
+        color_index = palette.name_to_index.get(color_name)
+        if color_index is not None:
+            shopping_data.append({
+                "Color Name": color_name,
+                "quantity": count,
+                "Color Preview": palette.hex_colors[color_index],
+                "elementId": palette.element_ids[color_index]
+            })
+
+    if mosaic_size:
+        layout = plan_baseplates(*mosaic_dimensions(mosaic_size))
+        shopping_data.insert(0, {  # insert at top of list
+            "Color Name": f"Baseplate {layout.name}",
+            "quantity": layout.count,
+            "Color Preview": "#DDDDDD",  # neutral gray placeholder
+            "elementId": layout.element_id
+        })
+
+    return pd.DataFrame(shopping_data).sort_values(by="quantity", ascending=False)
+
+def shopping_list_csv(shopping_df):
+    """Pick a Brick CSV (elementId, quantity) of a shopping list."""
+    # Plates without a known elementId cannot be ordered through Pick a Brick
+    orderable = shopping_df[shopping_df["elementId"].notna()]
+    return orderable[["elementId", "quantity"]].astype({"elementId": "int64"}).to_csv(index=False)
+
+
+# Keys of the service account entry in the Streamlit secrets
+_SERVICE_ACCOUNT_KEYS = (
+    "type", "project_id", "private_key_id", "private_key", "client_email", "client_id",
+    "auth_uri", "token_uri", "auth_provider_x509_cert_url", "client_x509_cert_url",
+    "universe_domain",
+)
+
+# Worksheets of the lego_feedback spreadsheet
+FEEDBACK_WORKSHEET = 0
+EVENTS_WORKSHEET = 1
+
+def _google_sheets_sink():
+    creds_dict = {key: st.secrets["gcp_service_account"][key] for key in _SERVICE_ACCOUNT_KEYS}
+    return GoogleSheetsSink(creds_dict, "lego_feedback")
+
+def _log_event(worksheet, row):
+    """Queue an analytics row; it is written to Google Sheets in the background."""
+    get_event_logger(_google_sheets_sink).log(worksheet, row)
 
 def save_feedback_to_google_sheets(rating, comment):
-    # Path to your service account key JSON file
-    creds_dict = {
-        "type": st.secrets["gcp_service_account"]["type"],
-        "project_id": st.secrets["gcp_service_account"]["project_id"],
-        "private_key_id": st.secrets["gcp_service_account"]["private_key_id"],
-        "private_key": st.secrets["gcp_service_account"]["private_key"],
-        "client_email": st.secrets["gcp_service_account"]["client_email"],
-        "client_id": st.secrets["gcp_service_account"]["client_id"],
-        "auth_uri": st.secrets["gcp_service_account"]["auth_uri"],
-        "token_uri": st.secrets["gcp_service_account"]["token_uri"],
-        "auth_provider_x509_cert_url": st.secrets["gcp_service_account"]["auth_provider_x509_cert_url"],
-        "client_x509_cert_url": st.secrets["gcp_service_account"]["client_x509_cert_url"],
-        "universe_domain": st.secrets["gcp_service_account"]["universe_domain"]
-    }
-    
-    # Connect to Google Sheets
-    scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
-    creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
-    client = gspread.authorize(creds)
-    
-    # Open the sheet (by name or by URL)
-    sheet = client.open("lego_feedback").sheet1  # Assuming first sheet
-    
-    # Prepare feedback data
     timestamp = datetime.now().isoformat()
     rating = rating if rating else ""
     comment = comment if comment else ""
-    
-    # Append the feedback as a new row
-    sheet.append_row([timestamp, rating, comment])
-
+    _log_event(FEEDBACK_WORKSHEET, [timestamp, rating, comment])
 
 def save_instruction_download_to_google_sheets():
-    creds_dict = {
-        "type": st.secrets["gcp_service_account"]["type"],
-        "project_id": st.secrets["gcp_service_account"]["project_id"],
-        "private_key_id": st.secrets["gcp_service_account"]["private_key_id"],
-        "private_key": st.secrets["gcp_service_account"]["private_key"],
-        "client_email": st.secrets["gcp_service_account"]["client_email"],
-        "client_id": st.secrets["gcp_service_account"]["client_id"],
-        "auth_uri": st.secrets["gcp_service_account"]["auth_uri"],
-        "token_uri": st.secrets["gcp_service_account"]["token_uri"],
-        "auth_provider_x509_cert_url": st.secrets["gcp_service_account"]["auth_provider_x509_cert_url"],
-        "client_x509_cert_url": st.secrets["gcp_service_account"]["client_x509_cert_url"],
-        "universe_domain": st.secrets["gcp_service_account"]["universe_domain"]
-    }
-
-    scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
-    creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
-    client = gspread.authorize(creds)
-
-    # Access the second sheet
-    sheet = client.open("lego_feedback").get_worksheet(1)  # Sheet2
-
-    timestamp = datetime.now().isoformat()
-    sheet.append_row([timestamp, "instruction_download"])
+    _log_event(EVENTS_WORKSHEET, [datetime.now().isoformat(), "instruction_download"])
 
 def save_mosaic_download_to_google_sheets():
-    creds_dict = {
-        "type": st.secrets["gcp_service_account"]["type"],
-        "project_id": st.secrets["gcp_service_account"]["project_id"],
-        "private_key_id": st.secrets["gcp_service_account"]["private_key_id"],
-        "private_key": st.secrets["gcp_service_account"]["private_key"],
-        "client_email": st.secrets["gcp_service_account"]["client_email"],
-        "client_id": st.secrets["gcp_service_account"]["client_id"],
-        "auth_uri": st.secrets["gcp_service_account"]["auth_uri"],
-        "token_uri": st.secrets["gcp_service_account"]["token_uri"],
-        "auth_provider_x509_cert_url": st.secrets["gcp_service_account"]["auth_provider_x509_cert_url"],
-        "client_x509_cert_url": st.secrets["gcp_service_account"]["client_x509_cert_url"],
-        "universe_domain": st.secrets["gcp_service_account"]["universe_domain"]
-    }
-
-    scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
-    creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
-    client = gspread.authorize(creds)
-
-    sheet = client.open("lego_feedback").get_worksheet(1)  # Sheet2
-    timestamp = datetime.now().isoformat()
-    sheet.append_row([timestamp, "mosaic_image_download"])
+    _log_event(EVENTS_WORKSHEET, [datetime.now().isoformat(), "mosaic_image_download"])
 
 def save_shopping_list_download_to_google_sheets():
-    creds_dict = {
-        "type": st.secrets["gcp_service_account"]["type"],
-        "project_id": st.secrets["gcp_service_account"]["project_id"],
-        "private_key_id": st.secrets["gcp_service_account"]["private_key_id"],
-        "private_key": st.secrets["gcp_service_account"]["private_key"],
-        "client_email": st.secrets["gcp_service_account"]["client_email"],
-        "client_id": st.secrets["gcp_service_account"]["client_id"],
-        "auth_uri": st.secrets["gcp_service_account"]["auth_uri"],
-        "token_uri": st.secrets["gcp_service_account"]["token_uri"],
-        "auth_provider_x509_cert_url": st.secrets["gcp_service_account"]["auth_provider_x509_cert_url"],
-        "client_x509_cert_url": st.secrets["gcp_service_account"]["client_x509_cert_url"],
-        "universe_domain": st.secrets["gcp_service_account"]["universe_domain"]
-    }
-
-    scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
-    creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
-    client = gspread.authorize(creds)
-
-    sheet = client.open("lego_feedback").get_worksheet(1)  # Sheet2
-    timestamp = datetime.now().isoformat()
-    sheet.append_row([timestamp, "shopping_list_download"])
-
+    _log_event(EVENTS_WORKSHEET, [datetime.now().isoformat(), "shopping_list_download"])
@@ -0,0 +1,228 @@
+import zlib
+from xml.sax.saxutils import escape
+
+import numpy as np
+
+from mosaic import as_mosaic
+from palette import get_palette
+
+# Vector formats accepted by vector_instructions
+VECTOR_FORMATS = ("svg", "pdf")
+
+VECTOR_MIME_TYPES = {"svg": "image/svg+xml", "pdf": "application/pdf"}
+
+# Legend layout, matching draw_instructions: 4 entries per row, 25 units per row, 40 for
+# the header and padding
+_LEGEND_COLUMNS = 4
+_LEGEND_ROW_HEIGHT = 25
+_LEGEND_PADDING = 40
+
+# Largest page side a PDF viewer has to accept, in points
+_PDF_MAX_PAGE_SIZE = 14400
+
+# Advance width of a digit in Helvetica, as a fraction of the font size
+_HELVETICA_DIGIT_WIDTH = 0.556
+
+
+def _color_numbers(color_counts, color_numbers):
+    if color_numbers is not None:
+        return dict(color_numbers)
+    return {color_name: i + 1 for i, color_name in enumerate(color_counts or {})}
+
+
+def _legend_entries(color_counts, lego_colors_used):
+    """(palette index into the legend palette, name, count) for every legend entry."""
+    if not color_counts or not lego_colors_used:
+        return None, []
+    palette = get_palette(lego_colors_used)
+    entries = [(palette.name_to_index[name], name, count) for name, count in color_counts.items()
+               if name in palette.name_to_index]
+    return palette, entries
+
+
+def _hex(rgb):
+    return "#%02X%02X%02X" % tuple(int(v) for v in rgb)
+
+
+def instructions_svg(mosaic_data, cell_size=24, color_counts=None, lego_colors_used=None,
+                     color_numbers=None):
+    """Draw the building instructions as an SVG document.
+
+    Every used color is defined once as a ``<symbol>`` (outlined square plus number) and
+    each cell is a ``<use>`` of it, so the output grows with the number of cells and not
+    with the drawn area. Arguments match draw_instructions.
+
+    Returns:
+        The SVG document as a string.
+    """
+    mosaic_data = as_mosaic(mosaic_data)
+    palette = mosaic_data.palette
+    numbers = _color_numbers(color_counts, color_numbers)
+    legend_palette, legend = _legend_entries(color_counts, lego_colors_used)
+
+    grid_height = mosaic_data.height * cell_size
+    legend_height = 0
+    if legend_palette is not None:
+        legend_height = -(-len(color_counts) // _LEGEND_COLUMNS) * _LEGEND_ROW_HEIGHT + _LEGEND_PADDING
+    width = mosaic_data.width * cell_size
+    height = grid_height + legend_height
+    font_size = max(cell_size * 0.42, 4)
+
+    parts = [
+        f'<svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink" '
+        f'width="{width}" height="{height}" viewBox="0 0 {width} {height}" '
+        f'font-family="Helvetica, Arial, sans-serif">',
+        f'<rect width="{width}" height="{height}" fill="#FFFFFF"/>',
+        "<defs>",
+    ]
+    used = np.unique(mosaic_data.indices).tolist()
+    for color_index in used:
+        number = numbers.get(palette.names[color_index], 0)
+        parts.append(
+            f'<symbol id="c{color_index}" overflow="visible">'
+            f'<rect x="0.5" y="0.5" width="{cell_size - 1}" height="{cell_size - 1}" '
+            f'fill="{palette.hex_colors[color_index]}" stroke="#000000"/>'
+            f'<text x="{cell_size / 2:g}" y="{cell_size / 2:g}" font-size="{font_size:.1f}" '
+            f'text-anchor="middle" dominant-baseline="central" '
+            f'fill="{_hex(palette.text_rgb[color_index])}">{number}</text></symbol>')
+    parts.append("</defs>")
+
+    # One <use> per cell, x offsets shared by every row
+    x_offsets = [f'" x="{x * cell_size}"/>' for x in range(mosaic_data.width)]
+    for y, index_row in enumerate(mosaic_data.indices.tolist()):
+        parts.append(f'<g transform="translate(0 {y * cell_size})">')
+        parts.append("".join(f'<use xlink:href="#c{color_index}{x_offsets[x]}'
+                             for x, color_index in enumerate(index_row)))
+        parts.append("</g>")
+
+    if legend_palette is not None:
+        parts.append(f'<text x="10" y="{grid_height + 20}" font-size="12">Color Legend:</text>')
+        column_width = width // _LEGEND_COLUMNS
+        for i, (color_index, color_name, count) in enumerate(legend):
+            x = (i % _LEGEND_COLUMNS) * column_width + 10
+            y = grid_height + 35 + (i // _LEGEND_COLUMNS) * _LEGEND_ROW_HEIGHT
+            parts.append(
+                f'<rect x="{x}" y="{y}" width="15" height="15" '
+                f'fill="{_hex(legend_palette.rgb[color_index])}" stroke="#000000"/>'
+                f'<text x="{x + 7.5}" y="{y + 11}" font-size="9" text-anchor="middle" '
+                f'fill="{_hex(legend_palette.text_rgb[color_index])}">{numbers.get(color_name, 0)}</text>'
+                f'<text x="{x + 20}" y="{y + 12}" font-size="11">{escape(color_name)} ({count})</text>')
+    parts.append("</svg>")
+    return "\n".join(parts)
+
+
+def _pdf_color(rgb, operator):
+    return "%.3f %.3f %.3f %s" % (*(int(v) / 255 for v in rgb), operator)
+
+
+def _pdf_text(text):
+    """Escape a string for a PDF literal, dropping characters outside Latin-1."""
+    text = text.encode("latin-1", "replace").decode("latin-1")
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def _pdf_document(page_width, page_height, content, forms):
+    """Assemble a single-page PDF from a content stream and named form XObjects."""
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        None,  # the page, filled in once the XObject numbers are known
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>",
+    ]
+
+    def stream(data, header=b""):
+        packed = zlib.compress(data)
+        return (b"<< " + header + b"/Filter /FlateDecode /Length %d >>\nstream\n" % len(packed)
+                + packed + b"\nendstream")
+
+    xobjects = []
+    for name, (form_content, size) in forms.items():
+        objects.append(stream(form_content, b"/Type /XObject /Subtype /Form /BBox [0 0 %g %g] "
+                              b"/Resources << /Font << /F1 4 0 R >> >> " % (size, size)))
+        xobjects.append(b"/%s %d 0 R" % (name.encode(), len(objects)))
+    objects.append(stream(content))
+    objects[2] = (b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %g %g] /Contents %d 0 R "
+                  b"/Resources << /Font << /F1 4 0 R >> /XObject << %s >> >> >>"
+                  % (page_width, page_height, len(objects), b" ".join(xobjects)))
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n" % number + body + b"\nendobj\n"
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    out += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    return bytes(out)
+
+
+def instructions_pdf(mosaic_data, cell_size=24, color_counts=None, lego_colors_used=None,
+                     color_numbers=None):
+    """Draw the building instructions as a single-page PDF.
+
+    Every used color is a form XObject drawn once per cell, the PDF counterpart of the
+    shared SVG symbols. Cells are scaled down if the page would exceed the largest page
+    size PDF viewers accept. Arguments match draw_instructions, with ``cell_size`` in points.
+
+    Returns:
+        The PDF document as bytes.
+    """
+    mosaic_data = as_mosaic(mosaic_data)
+    palette = mosaic_data.palette
+    numbers = _color_numbers(color_counts, color_numbers)
+    legend_palette, legend = _legend_entries(color_counts, lego_colors_used)
+
+    legend_height = 0
+    if legend_palette is not None:
+        legend_height = -(-len(color_counts) // _LEGEND_COLUMNS) * _LEGEND_ROW_HEIGHT + _LEGEND_PADDING
+    cell_size = min(cell_size, (_PDF_MAX_PAGE_SIZE - legend_height) / mosaic_data.height,
+                    _PDF_MAX_PAGE_SIZE / mosaic_data.width)
+    grid_height = mosaic_data.height * cell_size
+    width = mosaic_data.width * cell_size
+    height = grid_height + legend_height
+    font_size = max(cell_size * 0.42, 2)
+
+    forms = {}
+    for color_index in np.unique(mosaic_data.indices).tolist():
+        number = str(numbers.get(palette.names[color_index], 0))
+        text_x = (cell_size - len(number) * _HELVETICA_DIGIT_WIDTH * font_size) / 2
+        text_y = (cell_size - font_size * 0.7) / 2
+        forms[f"C{color_index}"] = ((
+            f"{_pdf_color(palette.rgb[color_index], 'rg')} 0 0 0 RG 0.5 w "
+            f"0.25 0.25 {cell_size - 0.5:g} {cell_size - 0.5:g} re B "
+            f"{_pdf_color(palette.text_rgb[color_index], 'rg')} "
+            f"BT /F1 {font_size:.2f} Tf {text_x:.2f} {text_y:.2f} Td ({number}) Tj ET"
+        ).encode(), cell_size)
+
+    # PDF places the origin at the bottom left; the grid is drawn from the top down
+    lines = ["1 1 1 rg 0 0 %g %g re f" % (width, height)]
+    for y, index_row in enumerate(mosaic_data.indices.tolist()):
+        top = height - (y + 1) * cell_size
+        lines.extend(f"q 1 0 0 1 {x * cell_size:g} {top:g} cm /C{color_index} Do Q"
+                     for x, color_index in enumerate(index_row))
+
+    if legend_palette is not None:
+        lines.append("0 0 0 rg BT /F1 12 Tf 10 %g Td (Color Legend:) Tj ET" % (legend_height - 20))
+        column_width = width // _LEGEND_COLUMNS
+        for i, (color_index, color_name, count) in enumerate(legend):
+            x = (i % _LEGEND_COLUMNS) * column_width + 10
+            y = legend_height - 50 - (i // _LEGEND_COLUMNS) * _LEGEND_ROW_HEIGHT
+            number = str(numbers.get(color_name, 0))
+            lines.append(
+                f"{_pdf_color(legend_palette.rgb[color_index], 'rg')} 0 0 0 RG 1 w {x:g} {y:g} 15 15 re B "
+                f"{_pdf_color(legend_palette.text_rgb[color_index], 'rg')} BT /F1 9 Tf "
+                f"{x + 7.5 - len(number) * _HELVETICA_DIGIT_WIDTH * 4.5:.2f} {y + 4:g} Td ({number}) Tj ET "
+                f"0 0 0 rg BT /F1 11 Tf {x + 20:g} {y + 3:g} Td ({_pdf_text(color_name)} \\({count}\\)) Tj ET")
+    return _pdf_document(width, height, "\n".join(lines).encode(), forms)
+
+
+def vector_instructions(mosaic_data, fmt="svg", cell_size=24, color_counts=None, lego_colors_used=None,
+                        color_numbers=None):
+    """Draw the building instructions as SVG or PDF and return the encoded bytes."""
+    if fmt not in VECTOR_FORMATS:
+        raise ValueError(f"Unknown vector format: {fmt}")
+    if fmt == "svg":
+        return instructions_svg(mosaic_data, cell_size, color_counts, lego_colors_used,
+                                color_numbers).encode("utf-8")
+    return instructions_pdf(mosaic_data, cell_size, color_counts, lego_colors_used, color_numbers)